@@ -0,0 +1,118 @@
+'''Precomposited animations (animated gif/webp) for the slide show.
+Every frame is composited and written once as raw RGB into a frame file, at its own
+size or shrunk to fit the screen if it is larger. Playback memory maps the file and
+scales each frame up to the screen as it is drawn, so showing a frame never decodes
+anything and small animations take little space.'''
+
+import bisect
+import mmap
+import struct
+
+import pygame
+from PIL import Image, ImageSequence
+
+import imageconvert
+
+MAGIC = b'IFA2'
+HEADER = struct.Struct('<4sHHHHI') # magic, stored width, height, shown width, height, frame count
+DURATION = struct.Struct('<I') # per frame, in ms
+MODE = 'RGB'
+BYTES_PER_PIXEL = 3
+DEFAULT_DURATION = 100
+MIN_DURATION = 20 # browsers treat 0-10ms delays as "as fast as possible", which is too fast for the Pi
+
+
+class AnimationTooLarge(Exception):
+    pass
+
+
+def is_animated(image_path):
+    with Image.open(image_path) as pil_image:
+        return getattr(pil_image, 'is_animated', False)
+
+def write_frames(image_path, image_size, fp, max_frames, max_bytes, resample=imageconvert.DEFAULT_RESAMPLE):
+    '''Composite and fit every frame of image_path into fp.
+    Raises AnimationTooLarge before writing anything if the animation is over budget.'''
+    with Image.open(image_path) as pil_image:
+        frame_count = pil_image.n_frames
+        shown = imageconvert.fit_size(pil_image.size, image_size)
+        #never stored larger than the image itself, playback does the upscaling
+        size = shown if shown[0] <= pil_image.size[0] else pil_image.size
+        frame_bytes = size[0] * size[1] * BYTES_PER_PIXEL
+
+        if frame_count > max_frames or frame_count * frame_bytes > max_bytes:
+            raise AnimationTooLarge("{} has {} frames, {} bytes".format(image_path, frame_count, frame_count * frame_bytes))
+
+        resample_filter = imageconvert.RESAMPLE_FILTERS.get(resample, imageconvert.RESAMPLE_FILTERS[imageconvert.DEFAULT_RESAMPLE])
+        #reused for every frame; the screen behind a slide is black
+        background = Image.new(MODE, size)
+        durations = []
+
+        #frames are streamed straight to fp, the durations follow them
+        fp.write(HEADER.pack(MAGIC, size[0], size[1], shown[0], shown[1], frame_count))
+        for frame in ImageSequence.Iterator(pil_image):
+            durations.append(max(MIN_DURATION, frame.info.get('duration') or DEFAULT_DURATION))
+            #pil hands back each frame already composited with the ones before it
+            rgba = frame.convert('RGBA')
+            if rgba.size != size:
+                rgba = rgba.resize(size, resample_filter)
+            background.paste((0, 0, 0), (0, 0) + size)
+            background.paste(rgba, (0, 0), rgba)
+            fp.write(background.tobytes())
+
+    for duration in durations:
+        fp.write(DURATION.pack(duration))
+
+
+class Animation(object):
+    '''Playback side of a frame file. Frames are surfaces over the memory map, not copies,
+    scaled to size into one surface allocated for the purpose if they were stored smaller.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as frame_file:
+            self.map = mmap.mmap(frame_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, width, height, shown_width, shown_height, frame_count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise IOError("{} is not a frame file".format(path))
+
+        self.stored_size = (width, height)
+        self.size = (shown_width, shown_height)
+        self.scaled = None # the surface frames are scaled into, made on first use
+        self.frame_bytes = width * height * BYTES_PER_PIXEL
+        self.data_offset = HEADER.size
+        offset = self.data_offset + frame_count * self.frame_bytes
+        self.durations = []
+        for i in range(frame_count):
+            self.durations.append(DURATION.unpack_from(self.map, offset)[0] / 1000.0)
+            offset += DURATION.size
+        self.view = memoryview(self.map)
+
+        #when each frame ends, relative to the start of a loop
+        self.ends = []
+        elapsed = 0
+        for duration in self.durations:
+            elapsed += duration
+            self.ends.append(elapsed)
+        self.loop_time = elapsed
+
+    def __len__(self):
+        return len(self.durations)
+
+    def surface(self, index):
+        '''Frame index at self.size. A scaled frame is only good until the next call.'''
+        start = self.data_offset + index * self.frame_bytes
+        frame = pygame.image.frombuffer(self.view[start:start + self.frame_bytes], self.stored_size, MODE)
+        if self.stored_size == self.size:
+            return frame
+        if self.scaled is None:
+            self.scaled = pygame.Surface(self.size, 0, frame)
+        return pygame.transform.scale(frame, self.size, self.scaled)
+
+    def frame_at(self, elapsed):
+        '''Index of the frame to show elapsed seconds after playback started'''
+        return bisect.bisect_right(self.ends, elapsed % self.loop_time) % len(self.ends)
+
+    def time_to_next_frame(self, elapsed):
+        into_loop = elapsed % self.loop_time
+        return self.ends[self.frame_at(elapsed)] - into_loop
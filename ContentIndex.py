@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+
+
+class ContentIndex(object):
+    '''Which files hold which picture, kept in sqlite and updated as images come and go.
+    Every downloaded body is identified by the hash of its bytes, so the same picture
+    found at another url or under another term is stored once and hardlinked.
+    A 64 bit perceptual hash (dHash) per picture tells near duplicates apart from
+    different pictures apart: resized or recompressed copies differ in a few bits.'''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS contents (digest TEXT PRIMARY KEY, phash TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, digest TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_digest ON files (digest)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT)')
+
+        #path -> (digest, phash) so the slide show can compare neighbours without a query
+        #phashes are stored as hex, sqlite integers are signed 64 bit
+        self.files = {path: (digest, int(phash, 16) if phash else None) for path, digest, phash in
+                      self.db.execute('SELECT path, digest, phash FROM files JOIN contents USING (digest)')}
+        self.linked = 0
+        self.downloads_avoided = 0
+        self.near_duplicates_skipped = 0
+
+    def find(self, digest):
+        '''A file on disk holding digest, or None. Files deleted behind our back are forgotten.'''
+        with self.lock:
+            for (path,) in self.db.execute('SELECT path FROM files WHERE digest=?', (digest,)).fetchall():
+                if os.path.exists(path):
+                    return path
+                self.forget(path)
+        return None
+
+    def find_url(self, url):
+        '''A file on disk holding what url was last seen to serve, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM urls WHERE url=?', (url,)).fetchone()
+        if row is None:
+            return None
+        path = self.find(row[0])
+        if path:
+            with self.lock:
+                self.downloads_avoided += 1
+        return path
+
+    def has_url_in(self, url, directory):
+        '''True if a file in directory holds what url was last seen to serve'''
+        with self.lock:
+            paths = self.db.execute('SELECT path FROM files JOIN urls USING (digest) WHERE url=?', (url,)).fetchall()
+        return any(os.path.dirname(path) == directory for (path,) in paths)
+
+    def add(self, path, url, digest, phash=None):
+        with self.lock:
+            if phash is None:
+                row = self.db.execute('SELECT phash FROM contents WHERE digest=?', (digest,)).fetchone()
+                phash = int(row[0], 16) if row and row[0] else None
+            self.db.execute('INSERT OR REPLACE INTO contents VALUES (?, ?)',
+                            (digest, None if phash is None else '{:016x}'.format(phash)))
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (path, digest))
+            self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?)', (url, digest))
+            self.files[path] = (digest, phash)
+
+    def add_url(self, url, digest):
+        '''Remember what url serves without storing another file for it'''
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?)', (url, digest))
+
+    def link(self, source, path, url):
+        '''Make path another name for the indexed file source'''
+        with self.lock:
+            digest = self.files[source][0]
+        os.link(source, path)
+        self.add(path, url, digest)
+        with self.lock:
+            self.linked += 1
+
+    def forget(self, path):
+        #caller holds self.lock
+        self.db.execute('DELETE FROM files WHERE path=?', (path,))
+        self.files.pop(path, None)
+
+    def remove(self, path):
+        with self.lock:
+            self.forget(path)
+
+    def similar(self, a, b, max_distance):
+        '''True if the pictures at paths a and b are the same, or their perceptual
+        hashes differ in no more than max_distance bits'''
+        with self.lock:
+            first, second = self.files.get(a), self.files.get(b)
+            if not first or not second:
+                return False
+            if first[0] == second[0]:
+                same = True
+            elif first[1] is None or second[1] is None:
+                same = False
+            else:
+                same = bin(first[1] ^ second[1]).count('1') <= max_distance
+            if same:
+                self.near_duplicates_skipped += 1
+            return same
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        with self.lock:
+            contents = self.db.execute('SELECT COUNT(*) FROM contents').fetchone()[0]
+            return {'files': len(self.files),
+                    'contents': contents,
+                    'linked': self.linked,
+                    'downloads_avoided': self.downloads_avoided,
+                    'near_duplicates_skipped': self.near_duplicates_skipped}
@@ -0,0 +1,87 @@
+import threading
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DownloadPool(object):
+    '''Runs fetch(url, *args) for queued jobs on up to max_workers threads, with no more
+    than per_host of them talking to the same host at once. Jobs for a busy host wait
+    in line without tying up a thread, so one slow host cannot stall the rest.
+    With max_pending set, add() blocks while that many jobs are queued or running,
+    which makes the pool a bounded queue between producers and the downloads.'''
+
+    def __init__(self, fetch, max_workers, per_host, max_pending=None):
+        self.fetch = fetch
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.max_pending = max_pending
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.condition = threading.Condition()
+        self.waiting = {} # host -> deque of jobs
+        self.active = {} # host -> jobs running against it
+        self.running = 0
+        self.finished = deque()
+        self.closed = False
+
+    @staticmethod
+    def host(url):
+        return urllib.parse.urlsplit(url).netloc.lower()
+
+    def add(self, url, *args):
+        '''Queue a job. Safe to call from any thread until close()'''
+        with self.condition:
+            while self.max_pending and self.pending >= self.max_pending:
+                self.condition.wait()
+            self.pending += 1
+            self.waiting.setdefault(self.host(url), deque()).append((url,) + args)
+            self.dispatch()
+
+    def close(self):
+        '''No more jobs are coming; results() ends once the queued ones finish'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def dispatch(self):
+        #caller holds self.condition
+        for host in list(self.waiting):
+            jobs = self.waiting[host]
+            while jobs and self.running < self.max_workers and self.active.get(host, 0) < self.per_host:
+                self.active[host] = self.active.get(host, 0) + 1
+                self.running += 1
+                self.executor.submit(self.work, host, jobs.popleft())
+            if not jobs:
+                del self.waiting[host]
+
+    def work(self, host, job):
+        result, error = None, None
+        try:
+            result = self.fetch(*job)
+        except Exception as e:
+            error = e
+
+        with self.condition:
+            self.active[host] -= 1
+            if not self.active[host]:
+                del self.active[host]
+            self.running -= 1
+            self.pending -= 1
+            self.finished.append((job, result, error))
+            self.dispatch()
+            self.condition.notify_all()
+
+    def results(self):
+        '''Yield (job, result, error) in the order jobs finish'''
+        while True:
+            with self.condition:
+                while not self.finished and not (self.closed and not self.running and not self.waiting):
+                    self.condition.wait()
+                if not self.finished:
+                    return
+                item = self.finished.popleft()
+            yield item
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
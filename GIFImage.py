@@ -4,34 +4,37 @@ from PIL import Image
 import pygame
 from pygame.locals import *
 
+import threading
 import time
+from collections import OrderedDict
 
-class GIFImage(object):
-    def __init__(self, filename):
-        self.filename = filename
-        self.image = Image.open(filename)
-        self.frames = []
-        self.get_frames()
+def to_palette(pal):
+    #group the flat [r, g, b, r, g, b...] list into triples in one pass
+    return list(zip(pal[0::3], pal[1::3], pal[2::3]))
 
-        self.cur = 0
-        self.ptime = time.time()
+class GIFFrames(object):
+    """Decoded frames of a gif, shared between copies of a GIFImage.
+    Indexing gives [surface, duration] like the old frame list. When streaming,
+    frames are decoded on demand and only the cache_size most recent are kept."""
 
-        self.running = True
-        self.breakpoint = len(self.frames)-1
-        self.startpoint = 0
-        self.reversed = False
+    def __init__(self, filename, stream=False, cache_size=8):
+        self.image = Image.open(filename)
+        self.stream = stream
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.surfaces = OrderedDict() # frame index -> surface, least recently used first
+        self.durations = []
+        self.users = 1
+        self.scan()
 
-    def get_rect(self):
-        return pygame.rect.Rect((0,0), self.image.size)
+        if not stream:
+            for i in range(len(self.durations)):
+                self.decode(i)
 
-    def get_frames(self):
+    def scan(self):
         image = self.image
 
-        pal = image.getpalette()
-        base_palette = []
-        for i in range(0, len(pal), 3):
-            rgb = pal[i:i+3]
-            base_palette.append(rgb)
+        self.base_palette = to_palette(image.getpalette())
 
         all_tiles = []
         try:
@@ -40,64 +43,99 @@ class GIFImage(object):
                     image.seek(0)
                 if image.tile:
                     all_tiles.append(image.tile[0][3][0])
+                try:
+                    duration = image.info["duration"]
+                except:
+                    duration = 100
+                self.durations.append(duration * .001) #convert to milliseconds!
                 image.seek(image.tell()+1)
         except EOFError:
             image.seek(0)
 
-        all_tiles = tuple(set(all_tiles))
+        self.all_tiles = tuple(set(all_tiles))
+        #each frame is drawn over the previous one
+        self.cons = self.all_tiles in ((6,), (7,))
 
-        try:
-            while 1:
-                try:
-                    duration = image.info["duration"]
-                except:
-                    duration = 100
+    def __len__(self):
+        return len(self.durations)
 
-                duration *= .001 #convert to milliseconds!
-                cons = False
+    def __getitem__(self, index):
+        return [self.surface(index), self.durations[index]]
 
-                x0, y0, x1, y1 = (0, 0) + image.size
-                if image.tile:
-                    tile = image.tile
-                else:
-                    image.seek(0)
-                    tile = image.tile
-                if len(tile) > 0:
-                    x0, y0, x1, y1 = tile[0][1]
-
-                if all_tiles:
-                    if all_tiles in ((6,), (7,)):
-                        cons = True
-                        pal = image.getpalette()
-                        palette = []
-                        for i in range(0, len(pal), 3):
-                            rgb = pal[i:i+3]
-                            palette.append(rgb)
-                    elif all_tiles in ((7, 8), (8, 7)):
-                        pal = image.getpalette()
-                        palette = []
-                        for i in range(0, len(pal), 3):
-                            rgb = pal[i:i+3]
-                            palette.append(rgb)
-                    else:
-                        palette = base_palette
-                else:
-                    palette = base_palette
-
-                pi = pygame.image.fromstring(image.tobytes(), image.size, image.mode)
-                pi.set_palette(palette)
-                if "transparency" in image.info:
-                    pi.set_colorkey(image.info["transparency"])
-                pi2 = pygame.Surface(image.size, SRCALPHA)
-                if cons:
-                    for i in self.frames:
-                        pi2.blit(i[0], (0,0))
-                pi2.blit(pi, (x0, y0), (x0, y0, x1-x0, y1-y0))
-
-                self.frames.append([pi2, duration])
-                image.seek(image.tell()+1)
-        except EOFError:
-            pass
+    def surface(self, index):
+        with self.lock:
+            try:
+                self.surfaces.move_to_end(index)
+                return self.surfaces[index]
+            except KeyError:
+                pass
+
+            start = index
+            if self.cons:
+                #composite forwards from the closest frame we still have
+                while start > 0 and start - 1 not in self.surfaces:
+                    start -= 1
+            for i in range(start, index + 1):
+                self.decode(i)
+            return self.surfaces[index]
+
+    def decode(self, index):
+        image = self.image
+        if image.tell() != index:
+            image.seek(index)
+
+        x0, y0, x1, y1 = (0, 0) + image.size
+        if image.tile:
+            tile = image.tile
+        else:
+            image.seek(0)
+            tile = image.tile
+        if len(tile) > 0:
+            x0, y0, x1, y1 = tile[0][1]
+
+        if self.all_tiles in ((6,), (7,), (7, 8), (8, 7)):
+            palette = to_palette(image.getpalette())
+        else:
+            palette = self.base_palette
+
+        pi = pygame.image.fromstring(image.tobytes(), image.size, image.mode)
+        pi.set_palette(palette)
+        if "transparency" in image.info:
+            pi.set_colorkey(image.info["transparency"])
+        pi2 = pygame.Surface(image.size, SRCALPHA)
+        if self.cons and index > 0:
+            #the previous frame already holds every frame before it
+            pi2.blit(self.surfaces[index-1], (0,0))
+        pi2.blit(pi, (x0, y0), (x0, y0, x1-x0, y1-y0))
+
+        self.surfaces[index] = pi2
+        if self.stream:
+            while len(self.surfaces) > self.cache_size:
+                self.surfaces.popitem(last=False)
+
+    def close(self):
+        self.users -= 1
+        if not self.users:
+            self.image.close()
+
+class GIFImage(object):
+    def __init__(self, filename, stream=False, cache_size=8, frames=None):
+        self.filename = filename
+        if frames is None:
+            frames = GIFFrames(filename, stream, cache_size)
+        self.frames = frames
+        self.image = frames.image
+
+        self.cur = 0
+        self.ptime = time.time()
+
+        self.running = True
+        self.breakpoint = len(self.frames)-1
+        self.startpoint = 0
+        self.reversed = False
+
+    def get_rect(self):
+        return pygame.rect.Rect((0,0), self.image.size)
 
     def render(self, screen, pos):
         if self.running:
@@ -108,6 +146,10 @@ class GIFImage(object):
                 self.ptime = time.time()
         screen.blit(self.frames[self.cur][0], pos)
 
+    def next_frame_time(self):
+        '''When render() will next move on to another frame'''
+        return self.ptime + self.frames[self.cur][1]
+
     # def render(self, screen, pos):
     #     if self.running:
     #         if time.time() - self.ptime > self.frames[self.cur][1]:
@@ -172,7 +214,9 @@ class GIFImage(object):
         self.reversed = False
 
     def copy(self):
-        new = GIFImage(self.filename)
+        #share the decoded frames rather than decoding the file again
+        self.frames.users += 1
+        new = GIFImage(self.filename, frames=self.frames)
         new.running = self.running
         new.breakpoint = self.breakpoint
         new.startpoint = self.startpoint
@@ -182,7 +226,7 @@ class GIFImage(object):
         return new
 
     def close(self):
-        self.image.close()
+        self.frames.close()
 
 ##def main():
 ##    pygame.init()
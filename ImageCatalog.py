@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class ImageCatalog(object):
+    '''Every image on disk with its term, size, mtime, dimensions and how often and
+    when it was last shown, kept in sqlite. Whoever adds or deletes an image updates
+    the catalog, so the cleaner and ^idea run a query instead of walking images/ and
+    stat-ing every file. sync() picks up whatever changed behind its back.'''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.remove_listeners = []
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS images
+                           (path TEXT PRIMARY KEY, term TEXT, size INTEGER, mtime REAL, width INTEGER, height INTEGER,
+                            last_shown REAL, display_count INTEGER DEFAULT 0, inode INTEGER)''')
+        if 'inode' not in [column[1] for column in self.db.execute('PRAGMA table_info(images)')]:
+            #catalogs from before hardlinked duplicates, sync() fills it in
+            self.db.execute('ALTER TABLE images ADD COLUMN inode INTEGER')
+        self.db.execute('CREATE INDEX IF NOT EXISTS images_term ON images (term)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS images_mtime ON images (mtime)')
+
+    def sync(self, image_dir, terms=None, skip=('.log',)):
+        '''Bring the catalog in line with what is under image_dir, one directory per term:
+        catalog files someone copied in by hand and forget ones that are gone. Only new
+        files, and old rows without an inode, are stat-ed. terms limits this to those term directories.
+        Returns (paths added, paths removed).'''
+        if terms is None:
+            terms = [term for term in os.listdir(image_dir) if os.path.isdir(os.path.join(image_dir, term))]
+            with self.lock:
+                #terms whose directory went away altogether
+                terms += [term for (term,) in self.db.execute('SELECT DISTINCT term FROM images') if term not in terms]
+
+        rows = []
+        removed = []
+        inodes = []
+        for term in terms:
+            term_dir = os.path.join(image_dir, term)
+            on_disk = set()
+            if os.path.isdir(term_dir):
+                on_disk = {entry.path for entry in os.scandir(term_dir) if entry.is_file() and not entry.name.endswith(skip)}
+            with self.lock:
+                known = dict(self.db.execute('SELECT path, inode FROM images WHERE term=?', (term,)))
+            for path in on_disk - set(known):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                rows.append((path, term, stat.st_size, stat.st_mtime, None, None, None, 0, stat.st_ino))
+            for path, inode in known.items():
+                if path not in on_disk:
+                    removed.append(path)
+                elif inode is None:
+                    try:
+                        inodes.append((os.stat(path).st_ino, path))
+                    except FileNotFoundError:
+                        removed.append(path)
+
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('DELETE FROM images WHERE path=?', ((path,) for path in removed))
+            self.db.executemany('UPDATE images SET inode=? WHERE path=?', inodes)
+            self.db.execute('COMMIT')
+        if removed:
+            for listener in self.remove_listeners:
+                listener(removed)
+        return [row[0] for row in rows], removed
+
+    def add(self, path, term, dimensions=(None, None)):
+        stat = os.stat(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, NULL, 0, ?)',
+                            (path, term, stat.st_size, stat.st_mtime) + tuple(dimensions) + (stat.st_ino,))
+
+    def on_remove(self, listener):
+        '''Call listener(paths) whenever images are deleted, by the cleaner, the delete key or by hand'''
+        self.remove_listeners.append(listener)
+
+    def remove(self, paths):
+        paths = list(paths)
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM images WHERE path=?', ((path,) for path in paths))
+            self.db.execute('COMMIT')
+        for listener in self.remove_listeners:
+            listener(paths)
+
+    def shown(self, path):
+        with self.lock:
+            self.db.execute('UPDATE images SET last_shown=?, display_count=display_count+1 WHERE path=?', (time.time(), path))
+
+    def dimensions(self, path):
+        with self.lock:
+            row = self.db.execute('SELECT width, height FROM images WHERE path=?', (path,)).fetchone()
+        return row if row else (None, None)
+
+    def paths(self, terms):
+        '''Paths of every image under terms'''
+        with self.lock:
+            paths = set()
+            for term in terms:
+                paths.update(path for (path,) in self.db.execute('SELECT path FROM images WHERE term=?', (term,)))
+            return paths
+
+    def term_stats(self):
+        '''(term, images, bytes, last shown) of every term, by term'''
+        with self.lock:
+            return self.db.execute('SELECT term, COUNT(*), COALESCE(SUM(size), 0), MAX(last_shown) FROM images '
+                                   'GROUP BY term ORDER BY term').fetchall()
+
+    def eviction_candidates(self):
+        '''(path, term, size, mtime, last_shown, display_count, inode) of every image'''
+        with self.lock:
+            return self.db.execute('SELECT path, term, size, mtime, last_shown, display_count, inode FROM images').fetchall()
+
+    def total_bytes(self):
+        '''Bytes on disk, counting hardlinked files once'''
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM '
+                                   '(SELECT MAX(size) AS size FROM images GROUP BY COALESCE(inode, path))').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        with self.lock:
+            images, terms, shown = self.db.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT term), COUNT(last_shown) FROM images').fetchone()
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM '
+                                    '(SELECT MAX(size) AS size FROM images GROUP BY COALESCE(inode, path))').fetchone()[0]
+            return {'images': images,
+                    'bytes': total,
+                    'terms': terms,
+                    'ever_shown': shown}
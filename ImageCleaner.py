@@ -1,13 +1,29 @@
 import os
+import heapq
+import shutil
 import threading
 import time
 import logging
 from collections import namedtuple
+from concurrent.futures import Future
+
+from config import vars
+
+DeletedItem = namedtuple('DeletedItem',['filename','age','space','reason'])
+MEGS = 1024*1024
 
 
 class ImageCleaner(threading.Thread):
+    '''Deletes images by whichever of these policies apply, in this order:
+    older than max_file_age, over a term's term_quota_mb, over the image_budget_mb
+    for all terms, or with less than min_free_mb left on the disk.
+    The last three pick the images to go from a heap ordered by eviction_policy:
+    least recently shown first (lru) or least often shown per day on disk (lfu).
+    Hardlinks to one file (see ContentIndex) count its bytes once and are evicted together,
+    since deleting all but the last of them frees nothing.
+    Deletions happen clean_batch_size at a time, so image_lock is only held briefly.'''
 
-    def __init__(self, image_dir, image_lock, image_set, max_file_age, image_clean_interval, clean_event, clean_msg_event, clean_msg_buffer, refresh_event):
+    def __init__(self, image_dir, image_lock, image_set, max_file_age, image_clean_interval, clean_event, refresh_event, catalog):
         super(self.__class__, self).__init__()
         self.daemon = True
         self.logger = logging.getLogger('main_logger')
@@ -17,44 +33,150 @@ class ImageCleaner(threading.Thread):
         self.max_file_age = max_file_age
         self.image_dir = image_dir
         self.clean_event = clean_event
-        self.clean_msg_event = clean_msg_event
-        self.clean_msg_buffer = clean_msg_buffer
         self.refresh_event = refresh_event
+        self.catalog = catalog
+        self.requests_lock = threading.Lock()
+        self.requests = [] # (dry_run, future, progress) of every clean someone is waiting on
+
+    def request(self, dry_run=False, progress=None):
+        '''Clean now. Returns a Future for the report, which is set even if nothing goes.
+        progress(line), if given, is called from the cleaner thread as batches are deleted.'''
+        future = Future()
+        with self.requests_lock:
+            self.requests.append((dry_run, future, progress))
+        self.clean_event.set()
+        return future
+
+    def priority(self, row, now):
+        '''Heap order of a catalog row, first out first'''
+        path, term, size, mtime, last_shown, display_count, inode = row
+        if vars['eviction_policy'] == 'lfu':
+            #shows per day on disk, counting one extra show so new images aren't evicted for not having been shown yet
+            return (display_count + 1) / max(1.0, (now - mtime) / (60*60*24))
+        return last_shown or mtime
+
+    @staticmethod
+    def file_key(row):
+        '''Same for every hardlink to one file'''
+        inode = row[6]
+        return ('inode', inode) if inode is not None else ('path', row[0])
+
+    def on_disk(self, rows, chosen=()):
+        '''Bytes the files of rows take up, leaving out files whose every link is chosen'''
+        sizes = {}
+        for row in rows:
+            if row[0] not in chosen:
+                sizes[self.file_key(row)] = row[2]
+        return sum(sizes.values())
+
+    def evict(self, rows, excess, reason, chosen, now):
+        '''Move files from the front of the heap into chosen, all their links at once,
+        until excess bytes are covered'''
+        links = {}
+        for row in rows:
+            if row[0] not in chosen:
+                links.setdefault(self.file_key(row), []).append(row)
+        heap = [(min(self.priority(row, now) for row in file_rows), key, file_rows) for key, file_rows in links.items()]
+        heapq.heapify(heap)
+        while excess > 0 and heap:
+            file_rows = heapq.heappop(heap)[2]
+            for row in file_rows:
+                chosen[row[0]] = (row, reason)
+            excess -= file_rows[0][2]
+
+    def choose(self):
+        '''path -> (catalog row, reason) of every image the policies want gone,
+        and every catalog row they were chosen from'''
+        now = time.time()
+        rows = self.catalog.eviction_candidates()
+        chosen = {}
 
-    def clean_up(self):
-        to_delete = set()
+        for row in rows:
+            if now - row[3] >= self.max_file_age:
+                chosen[row[0]] = (row, 'age')
+
+        term_quota = vars['term_quota_mb'] * MEGS
+        if term_quota > 0:
+            by_term = {}
+            for row in rows:
+                if row[0] not in chosen:
+                    by_term.setdefault(row[1], []).append(row)
+            for term, term_rows in by_term.items():
+                self.evict(term_rows, self.on_disk(term_rows) - term_quota, 'term quota', chosen, now)
+
+        remaining = self.on_disk(rows, chosen)
+        excess = 0
+        if vars['image_budget_mb'] > 0:
+            excess = remaining - vars['image_budget_mb'] * MEGS
+        if vars['min_free_mb'] > 0:
+            #what is already chosen will be freed too
+            freed = self.on_disk(rows) - remaining
+            free = shutil.disk_usage(self.image_dir).free + freed
+            excess = max(excess, vars['min_free_mb'] * MEGS - free)
+        self.evict(rows, excess, 'disk budget', chosen, now)
+
+        return chosen, rows
+
+    def delete(self, paths, progress=None):
+        batch_size = max(1, vars['clean_batch_size'])
+        for start in range(0, len(paths), batch_size):
+            batch = set(paths[start:start + batch_size])
+            self.image_lock.acquire()
+            for img in self.image_set & batch:
+                self.image_set.remove(img)
+            self.image_lock.release()
+
+            failed = set()
+            for img in batch:
+                try:
+                    os.unlink(img)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    #still on disk, so it stays in the catalog and is tried again next clean
+                    self.logger.info('Could not erase {}: {}'.format(img, e))
+                    failed.add(img)
+            self.catalog.remove(batch - failed)
+            if progress:
+                progress("Erased {}/{} images".format(min(len(paths), start + len(batch)), len(paths)))
+
+    def clean_up(self, dry_run=False, progress=None):
+        '''Returns a report of what was (or with dry_run, would be) deleted'''
+        now = time.time()
+        chosen, rows = self.choose()
+        #a file's bytes are credited to one of its links, and only if none is left behind
+        kept = {self.file_key(row) for row in rows if row[0] not in chosen}
+        credited = set()
         report = set()
-        DeletedItem = namedtuple('DeletedItem',['filename','age','space'])
-        for term in os.listdir(self.image_dir):
-            term_dir = os.path.join(self.image_dir, term)
-            for image in os.listdir(term_dir):
-                if image.endswith('.log'): # skip over log files
-                    continue
-                full_img_path = os.path.join(term_dir, image)
-                file_age = time.time() - os.stat(full_img_path).st_mtime
-                if file_age >= self.max_file_age:
-                    to_delete.add(full_img_path)
-                    report.add(DeletedItem(filename=os.path.join(term, image), age=file_age, space=os.stat(full_img_path).st_size))
-
-        self.image_lock.acquire()
-        for img in self.image_set & to_delete:
-            self.image_set.remove(img)
-        self.image_lock.release()
-
-        self.refresh_event.set()
-
-        for img in to_delete:
-            os.unlink(img)
-
-        if to_delete:
-            msg = "Erased images :{}".format(to_delete)
-            self.logger.info(msg)
-            self.clean_msg_buffer.append(report)
-            self.clean_msg_event.set()
+        for path, (row, reason) in chosen.items():
+            key = self.file_key(row)
+            space = row[2] if key not in kept and key not in credited else 0
+            credited.add(key)
+            report.add(DeletedItem(filename=os.path.join(row[1], os.path.basename(path)), age=now - row[3], space=space, reason=reason))
+
+        if chosen and not dry_run:
+            self.delete(list(chosen), progress)
+            self.refresh_event.set()
+            self.logger.info("Erased images :{}".format(set(chosen)))
+        return report
 
     def run(self):
         while True:
             self.clean_event.wait(self.image_clean_interval)
             self.clean_event.clear()
-            self.clean_up()
+            with self.requests_lock:
+                requests = self.requests
+                self.requests = []
 
+            if not requests:
+                #a failed scheduled clean must not end the thread, or no clean would ever run again
+                try:
+                    self.clean_up()
+                except Exception as e:
+                    self.logger.info('Clean failed: {}'.format(e))
+            for dry_run, future, progress in requests:
+                try:
+                    future.set_result(self.clean_up(dry_run, progress))
+                except Exception as e:
+                    self.logger.info('Clean failed: {}'.format(e))
+                    future.set_exception(e)
@@ -0,0 +1,85 @@
+import threading
+import logging
+
+
+class ImagePrefetcher(threading.Thread):
+    '''Decodes the slides surrounding the current position in the background
+    so that showing the next (or previous) image only costs a blit.'''
+
+    def __init__(self, load_slide, depth):
+        super(self.__class__, self).__init__()
+        self.daemon = True
+        self.logger = logging.getLogger('main_logger')
+        self.load_slide = load_slide
+        self.depth = depth
+        self.condition = threading.Condition()
+        self.window = [] # paths to keep decoded, most urgent first
+        self.ready = {} # path -> slide, never holds more than len(self.window) slides
+        self.failed = set()
+        self.loading = None
+
+    def neighbours(self, images, index):
+        # the current image first, then alternate forwards and backwards
+        window = [images[index]]
+        for step in range(1, self.depth + 1):
+            for offset in (step, -step):
+                path = images[(index + offset) % len(images)]
+                if path not in window:
+                    window.append(path)
+        return window
+
+    def update(self, images, index):
+        '''Follow the display loop to a new position or a rebuilt image list'''
+        if not images:
+            return
+
+        window = self.neighbours(images, index)
+        with self.condition:
+            self.window = window
+            for path in list(self.ready):
+                if path not in window:
+                    del self.ready[path]
+            self.failed.intersection_update(window)
+            self.condition.notify_all()
+
+    def get(self, path):
+        '''Return the decoded slide for path or None if it was not prefetched.
+        If path is being decoded right now, wait for it rather than decode it twice.'''
+        with self.condition:
+            while path == self.loading:
+                self.condition.wait()
+            return self.ready.get(path)
+
+    def discard(self, path):
+        with self.condition:
+            self.ready.pop(path, None)
+            if path in self.window:
+                self.window.remove(path)
+
+    def next_path(self):
+        for path in self.window:
+            if path not in self.ready and path not in self.failed:
+                return path
+
+    def run(self):
+        while True:
+            with self.condition:
+                path = self.next_path()
+                while path is None:
+                    self.condition.wait()
+                    path = self.next_path()
+                self.loading = path
+
+            slide = None
+            try:
+                slide = self.load_slide(path)
+            except Exception as e:
+                self.logger.info('Prefetch failed for {}: {}'.format(path, e))
+
+            with self.condition:
+                self.loading = None
+                if slide is None:
+                    self.failed.add(path)
+                elif path in self.window:
+                    self.ready[path] = slide
+                self.condition.notify_all()
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+
+class Job(object):
+    '''A long running control server command. It runs on a worker thread while
+    clients poll it with ^job or follow its progress with ^wait.
+    Lives on the server's event loop: only call its methods from there.'''
+
+    def __init__(self, job_id, command):
+        self.id = job_id
+        self.command = command
+        self.status = 'running'
+        self.lines = [] # progress so far
+        self.result = None
+        self.started = time.time()
+        self.finished = None
+        self.updated = asyncio.Event()
+
+    def notify(self):
+        #wake everyone following the job, then arm a fresh event for the next change
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def progress(self, line):
+        self.lines.append(line)
+        self.notify()
+
+    def finish(self, result=None, error=None):
+        self.status = 'failed' if error else 'done'
+        self.result = 'Error: {}'.format(error) if error else result
+        self.finished = time.time()
+        self.notify()
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    async def follow(self, with_result=True):
+        '''Yield each progress line as it arrives, then the result'''
+        sent = 0
+        while True:
+            updated = self.updated
+            while sent < len(self.lines):
+                yield self.lines[sent]
+                sent += 1
+            if self.done:
+                if with_result and self.result is not None:
+                    yield self.result
+                return
+            await updated.wait()
+
+    def summary(self):
+        elapsed = (self.finished or time.time()) - self.started
+        return "{} {} {:.1f}s {}".format(self.id, self.status, elapsed, self.command)
+
+    def as_dict(self):
+        return {'job': self.id,
+                'command': self.command,
+                'status': self.status,
+                'started': self.started,
+                'finished': self.finished}
+
+    def describe(self):
+        lines = [self.summary()] + self.lines
+        if self.result is not None:
+            lines.append(str(self.result))
+        return '\r\n'.join(lines)
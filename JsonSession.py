@@ -0,0 +1,228 @@
+import json
+import shutil
+
+from config import vars, TYPE_RESOLUTION
+
+
+class JsonSession(object):
+    '''The machine readable side of the control server, entered with ^json.
+    Every request is a line holding a JSON object such as
+        {"id": 1, "cmd": "ring", "args": {"limit": 100}}
+    and gets back one line {"id": 1, "ok": true, "result": ...} or {"id": 1, "ok": false, "error": ...}.
+    A line holding a JSON array is a batch: its requests run in order on one worker thread
+    and are answered with an array in one line. A batch saves round trips, but it holds no
+    locks, so images may come and go between its requests.
+    Long listings (ring, existing) come a page at a time. The first page snapshots the whole
+    list, and the cursor it returns walks that snapshot however the images change meanwhile.'''
+
+    DEFAULT_LIMIT = 500
+    MAX_LIMIT = 5000
+    JOB_COMMANDS = ('clear', 'jobs', 'job', 'wait')
+    #vars that change more than a value, and have a command of their own
+    VARS_BY_COMMAND = {'search_terms': 'terms', 'extra_images': 'extra'}
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.commands = {'ring': self.ring,
+                         'existing': self.existing,
+                         'stats': self.stats,
+                         'idea': self.idea,
+                         'space': self.space,
+                         'terms': self.terms,
+                         'vars': self.vars,
+                         'extra': self.extra,
+                         'download': self.download,
+                         'clear': self.clear,
+                         'jobs': self.jobs,
+                         'job': self.job}
+
+    @staticmethod
+    def to_json(value):
+        #sets, e.g. search_terms, go out as sorted lists. Anything else json can't take as its str.
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        return str(value)
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message, default=self.to_json).encode('utf-8') + b'\n')
+        await self.writer.drain()
+
+    @staticmethod
+    def reply(request, result=None, error=None):
+        request_id = request.get('id') if isinstance(request, dict) else None
+        if error is not None:
+            return {'id': request_id, 'ok': False, 'error': str(error)}
+        return {'id': request_id, 'ok': True, 'result': result}
+
+    def paginate(self, args, make_items):
+        limit = max(1, min(int(args.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT))
+        cursor = args.get('cursor')
+        if cursor:
+            snapshot_id, _, offset = cursor.partition(':')
+            items = self.server.snapshot(snapshot_id)
+            if items is None:
+                raise ValueError('cursor expired, start over without one')
+            offset = int(offset)
+        else:
+            items = make_items()
+            snapshot_id = self.server.take_snapshot(items)
+            offset = 0
+
+        end = offset + limit
+        return {'items': items[offset:end],
+                'total': len(items),
+                'cursor': '{}:{}'.format(snapshot_id, end) if end < len(items) else None}
+
+    @staticmethod
+    def string_list(args, name):
+        '''args[name] as a list of strings, [] if it is missing'''
+        value = args.get(name, [])
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            raise ValueError('{} is a list of strings, not {}'.format(name, json.dumps(value)))
+        return value
+
+    #commands run on a worker thread
+
+    def ring(self, args):
+        return self.paginate(args, lambda: list(self.server.images))
+
+    def existing(self, args):
+        return self.paginate(args, lambda: [{'term': term, 'images': images, 'bytes': size, 'last_shown': last_shown}
+                                            for term, images, size, last_shown in self.server.catalog.term_stats()])
+
+    def stats(self, args):
+        return self.server.stats(args.get('name'))
+
+    def idea(self, args):
+        result = {'bytes': self.server.catalog.total_bytes()}
+        if 'ingest' in self.server.stats_sources:
+            result['ingest'] = self.server.stats_sources['ingest']()
+        return result
+
+    def space(self, args):
+        total, used, free = shutil.disk_usage("/")
+        return {'total': total, 'used': used, 'free': free}
+
+    def terms(self, args):
+        '''List search terms, or change them with {"add": [...], "remove": [...]}'''
+        terms = set(vars['search_terms'])
+        add, remove = set(self.string_list(args, 'add')), set(self.string_list(args, 'remove'))
+        if add - terms or terms & remove:
+            vars['search_terms'] = (terms | add) - remove
+            self.server.new_term_event.set()
+        return sorted(vars['search_terms'])
+
+    def vars(self, args):
+        '''All runtime parameters, after applying {"set": {key: value}} if given.
+        Values are JSON values or strings as ^vars takes them; term_weights is an object
+        of term: weight. Nothing is set unless every value is good.'''
+        parsed = {}
+        for key, value in args.get('set', {}).items():
+            if key in self.VARS_BY_COMMAND:
+                raise ValueError('change {} with the {} command'.format(key, self.VARS_BY_COMMAND[key]))
+            if key == 'term_weights' and isinstance(value, dict):
+                parsed[key] = {str(term): float(weight) for term, weight in value.items()}
+            elif isinstance(value, (dict, list)):
+                raise ValueError('{} takes a single value, not {}'.format(key, json.dumps(value)))
+            else:
+                parsed[key] = TYPE_RESOLUTION.get(key, str)(str(value))
+        vars.update(parsed)
+        return {key: sorted(value) if isinstance(value, (set, frozenset)) else value for key, value in vars.items()}
+
+    def extra(self, args):
+        tokens = self.string_list(args, 'add') + ['-' + term for term in self.string_list(args, 'remove')]
+        if tokens:
+            return sorted(self.server.add_extra_images("^extra" + ",".join(tokens)))
+        return sorted(vars['extra_images'])
+
+    def download(self, args):
+        self.server.new_term_event.set()
+        return True
+
+    #job commands run on the event loop
+
+    def clear(self, args):
+        dry_run = bool(args.get('dry'))
+        job = self.server.start_job('^clear dry' if dry_run else '^clear',
+                                    lambda progress: self.server.clear_oldies(dry_run, progress))
+        return job.as_dict()
+
+    def jobs(self, args):
+        return [job.as_dict() for job in self.server.jobs.values()]
+
+    def job(self, args):
+        job = self.server.jobs.get(args.get('job'))
+        if job is None:
+            raise KeyError('unknown job {}'.format(args.get('job')))
+        return dict(job.as_dict(), progress=job.lines, result=job.result)
+
+    def execute(self, request):
+        try:
+            return self.reply(request, self.commands[request['cmd']](request.get('args') or {}))
+        except KeyError as e:
+            if not isinstance(request.get('cmd'), str) or request['cmd'] not in self.commands:
+                return self.reply(request, error='unknown command {}'.format(request.get('cmd')))
+            return self.reply(request, error=e.args[0] if e.args else e)
+        except Exception as e:
+            return self.reply(request, error=e)
+
+    def execute_all(self, requests):
+        return [self.execute(request) for request in requests]
+
+    async def batch(self, requests):
+        '''Responses to requests, in order'''
+        responses = [None] * len(requests)
+        plain = []
+        for i, request in enumerate(requests):
+            if not isinstance(request, dict):
+                responses[i] = self.reply(request, error='a request is a JSON object')
+            elif request.get('cmd') == 'wait':
+                responses[i] = self.reply(request, error='wait cannot be batched')
+            elif request.get('cmd') in self.JOB_COMMANDS:
+                responses[i] = self.execute(request)
+            else:
+                plain.append(i)
+
+        if plain:
+            results = await self.server.run_blocking(self.execute_all, [requests[i] for i in plain])
+            for i, response in zip(plain, results):
+                responses[i] = response
+        return responses
+
+    async def wait(self, request):
+        '''Stream a job's progress lines, then its result'''
+        args = request.get('args') or {}
+        job = self.server.jobs.get(args.get('job'))
+        if job is None:
+            await self.send(self.reply(request, error='unknown job {}'.format(args.get('job'))))
+            return
+        async for line in job.follow(with_result=False):
+            await self.send({'id': request.get('id'), 'progress': line})
+        await self.send(self.reply(request, dict(job.as_dict(), result=job.result)))
+
+    async def handle(self):
+        '''Serve requests until {"cmd": "exit"}. Returns False if the client went away instead.'''
+        await self.send({'ok': True, 'result': {'commands': sorted(self.commands) + ['exit', 'wait']}})
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return False
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                await self.send({'id': None, 'ok': False, 'error': 'bad JSON: {}'.format(e)})
+                continue
+
+            if isinstance(request, list):
+                await self.send(await self.batch(request))
+            elif isinstance(request, dict) and request.get('cmd') == 'exit':
+                await self.send(self.reply(request, 'bye'))
+                return True
+            elif isinstance(request, dict) and request.get('cmd') == 'wait':
+                await self.wait(request)
+            else:
+                await self.send((await self.batch([request]))[0])
@@ -0,0 +1,90 @@
+import math
+import os
+import random
+import threading
+
+from sortedcontainers import SortedList
+
+
+class Playlist(object):
+    '''The images to show, in a weighted shuffle order that stays put as images come and go.
+    Each path gets a random sort key when it is added, drawn so that images of terms
+    with a larger weight tend to come first (Efraimidis-Spirakis: -log(u)/weight).
+    Paths are kept sorted by key, so adding or removing one is O(log n), looking one
+    up by position is O(log n), and everything else keeps its place. Indexes wrap
+    around, so playlist[len(playlist)] is playlist[0].
+    Works like a set of paths otherwise, and is safe to share between threads.'''
+
+    def __init__(self, paths=(), weights=None):
+        self.lock = threading.RLock()
+        self.weights = weights or (lambda: {})
+        self.keys = {} # path -> sort key
+        self.order = SortedList()
+        self.update(paths)
+
+    @staticmethod
+    def term(path):
+        return os.path.basename(os.path.dirname(path))
+
+    def make_key(self, path, weights):
+        weight = weights.get(self.term(path), 1.0)
+        if weight <= 0:
+            return float('inf')
+        #1 - random() is never 0, so the log is always defined
+        return -math.log(1.0 - random.random()) / weight
+
+    def add(self, path):
+        self.update((path,))
+
+    def update(self, paths):
+        weights = self.weights()
+        with self.lock:
+            for path in paths:
+                if path not in self.keys:
+                    key = self.keys[path] = self.make_key(path, weights)
+                    self.order.add((key, path))
+
+    def discard(self, path):
+        with self.lock:
+            key = self.keys.pop(path, None)
+            if key is not None:
+                self.order.remove((key, path))
+
+    def remove(self, path):
+        with self.lock:
+            if path not in self.keys:
+                raise KeyError(path)
+            self.discard(path)
+
+    def shuffle(self):
+        '''Deal a new order, with the current weights'''
+        weights = self.weights()
+        with self.lock:
+            self.keys = {path: self.make_key(path, weights) for path in self.keys}
+            self.order = SortedList((key, path) for path, key in self.keys.items())
+
+    def position(self, path):
+        '''Index of path, or None if it is not in the playlist'''
+        with self.lock:
+            key = self.keys.get(path)
+            if key is None:
+                return None
+            return self.order.index((key, path))
+
+    def __getitem__(self, index):
+        with self.lock:
+            return self.order[index % len(self.order)][1]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, path):
+        return path in self.keys
+
+    def __iter__(self):
+        with self.lock:
+            return iter([path for key, path in self.order])
+
+    def __and__(self, paths):
+        with self.lock:
+            return {path for path in paths if path in self.keys}
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from pygame import display, Rect
+from config import vars
+
+
+class ProgressOverlay(object):
+    '''Download progress lines drawn over the slide show.
+    Only the lines that changed are redrawn and pushed with display.update(rects),
+    and updates arriving faster than progress_max_fps are coalesced into the next render.
+    Only the renderer paints, on the main thread; update() may be called from anywhere.'''
+
+    def __init__(self, screen_size, font, detailed_font, background, padding):
+        width, height = screen_size
+        big = font.get_ascent()
+        small = detailed_font.get_ascent()
+
+        self.background = background
+        self.lock = threading.Lock()
+        #name -> (font, rect). Each line always repaints the same rect.
+        self.regions = {'percent': (font, Rect(width - 4 * big, 0, 4 * big, big + padding)),
+                        'url': (detailed_font, Rect(0, height - small*3 - padding*3, width, small + padding)),
+                        'download': (detailed_font, Rect(0, height - small*2 - padding*2, width, small + padding)),
+                        'total': (detailed_font, Rect(0, height - small - padding, width, small + padding))}
+        self.lines = {} # name -> (text, colour)
+        self.dirty = set()
+        self.last_render = 0
+        self.renders = 0
+        self.coalesced = 0
+        self.render_seconds = 0
+
+    def update(self, **lines):
+        '''Set lines, e.g. update(url=(url, colour)). None removes a line.'''
+        with self.lock:
+            for name, line in lines.items():
+                if self.lines.get(name) != line:
+                    if name in self.dirty:
+                        self.coalesced += 1
+                    self.lines[name] = line
+                    self.dirty.add(name)
+
+    def clear(self):
+        self.update(**{name: None for name in self.regions})
+
+    @staticmethod
+    def min_interval():
+        #a progress_max_fps of 0 or less means no cap
+        fps = vars['progress_max_fps']
+        return 1.0 / fps if fps > 0 else 0
+
+    def next_refresh_time(self):
+        '''When pending changes may be pushed, or None if nothing is pending'''
+        with self.lock:
+            if not self.dirty:
+                return None
+            return self.last_render + self.min_interval()
+
+    def refresh(self, screen):
+        '''Push pending changes to the display unless the last push was too recent'''
+        with self.lock:
+            if not self.dirty or time.time() - self.last_render < self.min_interval():
+                return
+            names = self.dirty
+            self.dirty = set()
+            self.last_render = time.time()
+
+        start = time.perf_counter()
+        rects = self.paint(screen, names)
+        display.update(rects)
+        self.count_render(start)
+
+    def draw(self, screen):
+        '''Paint every line onto a freshly drawn frame and return their rects.
+        The caller presents the frame.'''
+        with self.lock:
+            self.dirty = set()
+            names = [name for name, line in self.lines.items() if line]
+        start = time.perf_counter()
+        rects = self.paint(screen, names)
+        self.count_render(start)
+        return rects
+
+    def paint(self, screen, names):
+        rects = []
+        for name in names:
+            font, rect = self.regions[name]
+            screen.fill(self.background, rect)
+            line = self.lines.get(name)
+            if line:
+                text = font.render(line[0], 1, line[1])
+                #the percentage hugs the right edge, the rest start at the left
+                x_coord = rect.right - text.get_width() if name == 'percent' else rect.left
+                screen.blit(text, (x_coord, rect.top))
+            rects.append(rect)
+        return rects
+
+    def count_render(self, start):
+        with self.lock:
+            self.renders += 1
+            self.render_seconds += time.perf_counter() - start
+
+    def stats(self):
+        with self.lock:
+            return {'renders': self.renders,
+                    'coalesced': self.coalesced,
+                    'render_seconds': round(self.render_seconds, 3),
+                    'avg_render_ms': round(self.render_seconds * 1000 / self.renders, 2) if self.renders else 0}
@@ -0,0 +1,73 @@
+import json
+import logging
+import threading
+
+
+class QueryPlanner(object):
+    '''Decides where search API calls go, based on how many new, downloadable urls
+    each (term, image size) has turned up per call. Counts decay with every call so
+    the yield follows what a search returns now rather than months ago. Searches that
+    have not been tried start at an optimistic yield, so every one gets tried.'''
+
+    DECAY = 0.9 # weight an older call keeps each time a newer one is recorded
+    PRIOR_CALLS = 2 # how many calls' worth of optimism an untried search starts with
+
+    def __init__(self, path, page_size):
+        self.path = path
+        self.page_size = page_size
+        self.logger = logging.getLogger('main_logger')
+        self.lock = threading.Lock()
+        self.allowance = {} # term -> API calls left this round
+        try:
+            with open(path) as planner_file:
+                self.yields = json.load(planner_file) # term -> size -> {'calls', 'links', 'new'}
+        except (IOError, ValueError):
+            self.yields = {}
+
+    def expected_yield(self, term, size):
+        '''New urls a call for term at size is expected to find. Caller holds self.lock'''
+        counts = self.yields.get(term, {}).get(size, {})
+        prior = self.page_size / 2.0
+        return (counts.get('new', 0) + prior * self.PRIOR_CALLS) / (counts.get('calls', 0) + self.PRIOR_CALLS)
+
+    def order_sizes(self, term, sizes):
+        '''sizes, best yield first'''
+        with self.lock:
+            return sorted(sizes, key=lambda size: -self.expected_yield(term, size))
+
+    def allocate(self, terms, sizes, calls):
+        '''Share calls API calls between terms in proportion to the best yield each
+        has to offer. Every term gets at least one call so its yield stays current.'''
+        with self.lock:
+            best = {term: max(self.expected_yield(term, size) for size in sizes) for term in terms}
+            total = sum(best.values())
+            spare = max(0, calls - len(terms))
+            self.allowance = {term: 1 + (int(round(spare * best[term] / total)) if total else 0) for term in terms}
+            return dict(self.allowance)
+
+    def spend(self, term):
+        '''Use one of term's calls this round. False once they are gone.'''
+        with self.lock:
+            left = self.allowance.get(term, 0)
+            if left <= 0:
+                return False
+            self.allowance[term] = left - 1
+            return True
+
+    def record(self, term, size, links, new):
+        '''One API call for term at size returned links links, new of them worth downloading'''
+        with self.lock:
+            counts = self.yields.setdefault(term, {}).setdefault(size, {'calls': 0, 'links': 0, 'new': 0})
+            for name, amount in (('calls', 1), ('links', links), ('new', new)):
+                counts[name] = counts[name] * self.DECAY + amount
+            try:
+                with open(self.path, 'w') as planner_file:
+                    json.dump(self.yields, planner_file)
+            except IOError as e:
+                self.logger.info('Could not save query planner: {}'.format(e))
+
+    def stats(self):
+        with self.lock:
+            return {'yield_per_call': {term: {size: round(self.expected_yield(term, size), 2) for size in sizes}
+                                       for term, sizes in self.yields.items()},
+                    'calls_left': dict(self.allowance)}
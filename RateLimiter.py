@@ -0,0 +1,137 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+
+class TokenBucket(object):
+    '''Lets through rate() units a second on average, with bursts of up to one second's worth.
+    rate is called every time so a change made through ^vars applies straight away,
+    and a rate of 0 or less means no limit.'''
+
+    WINDOW = 10 # seconds of history behind the recent rate
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.last_refill = time.time()
+        self.recent = deque() # [second, amount taken in it], at most WINDOW of them
+        self.total = 0
+        self.waited = 0
+
+    def acquire(self, amount=1):
+        '''Take amount tokens, sleeping until the bucket has paid for them'''
+        rate = self.rate()
+        with self.lock:
+            now = time.time()
+            self.total += amount
+            self.count_recent(now, amount)
+            if rate <= 0:
+                self.tokens = 0
+                self.last_refill = now
+                return
+            self.tokens = min(rate, self.tokens + (now - self.last_refill) * rate)
+            self.last_refill = now
+            #go into debt rather than make a large request wait for a full bucket
+            self.tokens -= amount
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+
+    def count_recent(self, now, amount):
+        #caller holds self.lock
+        second = int(now)
+        if self.recent and self.recent[-1][0] == second:
+            self.recent[-1][1] += amount
+        elif amount:
+            self.recent.append([second, amount])
+        while self.recent and self.recent[0][0] <= second - self.WINDOW:
+            self.recent.popleft()
+
+    def recent_rate(self):
+        with self.lock:
+            self.count_recent(time.time(), 0)
+            return sum(amount for second, amount in self.recent) / float(self.WINDOW)
+
+    def stats(self):
+        rate = self.rate()
+        recent = self.recent_rate()
+        with self.lock:
+            return {'limit_per_sec': rate if rate > 0 else 'none',
+                    'recent_per_sec': round(recent, 1),
+                    'utilization': round(recent / rate, 2) if rate > 0 else None,
+                    'total': self.total,
+                    'seconds_waited': round(self.waited, 1)}
+
+
+class DailyQuota(object):
+    '''Counts search API requests per calendar day, kept in a file so restarts don't reset it.
+    limit() of 0 or less means no limit.'''
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.logger = logging.getLogger('main_logger')
+        self.lock = threading.Lock()
+        try:
+            with open(path) as quota_file:
+                saved = json.load(quota_file)
+            self.day, self.used = saved['day'], saved['used']
+        except (IOError, ValueError, KeyError):
+            self.day, self.used = time.strftime('%Y-%m-%d'), 0
+
+    def take(self):
+        '''Use one request of today's budget. False once it has run out.'''
+        limit = self.limit()
+        with self.lock:
+            today = time.strftime('%Y-%m-%d')
+            if today != self.day:
+                self.day, self.used = today, 0
+            if 0 < limit <= self.used:
+                return False
+            self.used += 1
+            try:
+                with open(self.path, 'w') as quota_file:
+                    json.dump({'day': self.day, 'used': self.used}, quota_file)
+            except IOError as e:
+                self.logger.info('Could not save API quota: {}'.format(e))
+            return True
+
+    def stats(self):
+        limit = self.limit()
+        with self.lock:
+            return {'day': self.day,
+                    'used': self.used,
+                    'remaining': max(0, limit - self.used) if limit > 0 else 'unlimited'}
+
+
+class RateLimiter(object):
+    '''Keeps the background downloads from swamping a slow link or SD card:
+    image bodies are held to a byte rate, and search API calls to a request rate
+    and a daily budget.'''
+
+    def __init__(self, download_rate, api_rate, api_daily_limit, quota_path):
+        self.download_bytes = TokenBucket(download_rate)
+        self.api_requests = TokenBucket(api_rate)
+        self.api_quota = DailyQuota(quota_path, api_daily_limit)
+        self.api_refused = 0
+
+    def download(self, num_bytes):
+        '''Account for num_bytes of image body, sleeping if they came too fast'''
+        self.download_bytes.acquire(num_bytes)
+
+    def api_request(self):
+        '''Wait for a search API call to be allowed. False if today's budget is spent.'''
+        if not self.api_quota.take():
+            self.api_refused += 1
+            return False
+        self.api_requests.acquire()
+        return True
+
+    def stats(self):
+        return {'download_bytes': self.download_bytes.stats(),
+                'api_requests': self.api_requests.stats(),
+                'api_quota': dict(self.api_quota.stats(), refused=self.api_refused)}
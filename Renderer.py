@@ -0,0 +1,208 @@
+import logging
+import queue
+import threading
+import time
+
+import imageconvert
+from pygame import display, Rect
+from Transition import Transition
+from config import vars
+
+
+class Renderer(object):
+    '''All drawing goes through here. Any thread may queue a command (show a slide, the
+    loading animation, progress text, the position indicator) and carry on, so nobody
+    waits for the screen. SDL only supports video calls on the thread that opened the
+    window, so the commands are carried out by pump() on the main thread: wake() is
+    called to get the main loop out of its event wait, and timeout() says how long it
+    may sleep before the next animation frame or overlay refresh is due.'''
+
+    def __init__(self, screen, overlay, background, font, font_colour, wake):
+        self.logger = logging.getLogger('main_logger')
+        self.screen = screen
+        self.overlay = overlay
+        self.background = background
+        self.font = font
+        self.font_colour = font_colour
+        self.commands = queue.Queue()
+        self.wake = wake
+        self.wake_lock = threading.Lock()
+        self.woken = False # a wake is already on its way, don't send another
+        self.transition = Transition(screen)
+        self.transition_pending = False
+
+        self.slide = None
+        self.slide_index = 0
+        self.slide_total = 0
+        self.slide_start = 0
+        self.frame = 0
+        self.loading = None # (gif, position)
+        self.show_position = False
+
+        self.stats_lock = threading.Lock()
+        self.frames_drawn = 0
+        self.frame_seconds = 0
+        self.max_frame_seconds = 0
+        self.last_frame_seconds = 0
+
+    #Called from any thread. None of these block.
+
+    def put(self, command):
+        self.commands.put(command)
+        with self.wake_lock:
+            if self.woken:
+                return
+            self.woken = True
+        self.wake()
+
+    def show_slide(self, slide, index, total):
+        self.put(('slide', slide, index, total))
+
+    def show_loading(self, gif, position):
+        self.put(('loading', gif, position))
+
+    def show_position_indicator(self, show):
+        self.put(('position', show))
+
+    def update_progress(self, **lines):
+        self.put(('progress', lines))
+
+    def clear_progress(self):
+        self.put(('clear_progress',))
+
+    def stats(self):
+        with self.stats_lock:
+            return {'frames': self.frames_drawn,
+                    'avg_frame_ms': round(self.frame_seconds * 1000 / self.frames_drawn, 2) if self.frames_drawn else 0,
+                    'max_frame_ms': round(self.max_frame_seconds * 1000, 2),
+                    'last_frame_ms': round(self.last_frame_seconds * 1000, 2),
+                    'queued_commands': self.commands.qsize(),
+                    'transitions': self.transition.stats()}
+
+    #Main thread only from here on
+
+    def handle(self, command):
+        '''Apply a command. Returns True when the whole screen has to be redrawn.'''
+        name = command[0]
+
+        if name == 'slide':
+            self.loading = None
+            #only transition between two slides, not out of the loading screen
+            self.transition_pending = self.slide is not None
+            slide, self.slide_index, self.slide_total = command[1:]
+            #slides are decoded on other threads, but convert() is a video call like any other
+            self.slide = slide._replace(surface=imageconvert.to_display_format(slide.surface))
+            self.slide_start = time.time()
+            self.frame = 0
+            return True
+        elif name == 'loading':
+            self.slide = None
+            self.loading = command[1:]
+            return True
+        elif name == 'position':
+            self.show_position = command[1]
+            return self.slide is not None
+        elif name == 'progress':
+            self.overlay.update(**command[1])
+        elif name == 'clear_progress':
+            self.overlay.clear()
+        return False
+
+    def next_deadline(self):
+        deadlines = [self.overlay.next_refresh_time()]
+        if self.slide and self.slide.animation:
+            elapsed = time.time() - self.slide_start
+            deadlines.append(time.time() + self.slide.animation.time_to_next_frame(elapsed))
+        if self.loading:
+            deadlines.append(self.loading[0].next_frame_time())
+
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def draw_position(self, target):
+        position = "{}/{}".format(self.slide_index + 1, self.slide_total)
+        text = self.font.render(position, 1, self.font_colour)
+        return target.blit(text, (0,0))
+
+    def paint_frame(self, target):
+        target.fill(self.background)
+        if self.slide:
+            target.blit(self.slide.surface, self.slide.position)
+            if self.show_position:
+                self.draw_position(target)
+        elif self.loading:
+            gif, position = self.loading
+            gif.render(target, position)
+        self.overlay.draw(target)
+
+    def draw_frame(self):
+        '''Redraw everything and flip, through a transition when moving between slides'''
+        kind = vars['transition']
+        #a transition with no frames or no time is no transition
+        if self.transition_pending and kind in Transition.KINDS and vars['transition_fps'] >= 1 and vars['transition_seconds'] > 0:
+            self.transition.run(self.screen, self.paint_frame, kind, vars['transition_seconds'], vars['transition_fps'])
+        else:
+            self.paint_frame(self.screen)
+            display.flip()
+        self.transition_pending = False
+
+    def draw_animation(self):
+        '''Draw the next frame of whatever is animating, if one is due, updating only its rect'''
+        rects = []
+        if self.slide and self.slide.animation:
+            animation = self.slide.animation
+            frame = animation.frame_at(time.time() - self.slide_start)
+            if frame == self.frame:
+                return False
+            self.frame = frame
+            rects.append(self.screen.blit(animation.surface(frame), self.slide.position))
+            if self.show_position:
+                rects.append(self.draw_position(self.screen))
+        elif self.loading:
+            gif, position = self.loading
+            if time.time() < gif.next_frame_time():
+                return False
+            gif.render(self.screen, position)
+            rects.append(Rect(position, gif.get_size()))
+        else:
+            return False
+
+        rects.extend(self.overlay.draw(self.screen))
+        display.update(rects)
+        return True
+
+    def timeout(self):
+        '''Seconds until pump() has something to draw, or None if only a new command will'''
+        deadline = self.next_deadline()
+        return None if deadline is None else max(0, deadline - time.time())
+
+    def pump(self):
+        '''Carry out every queued command, then draw whatever is due'''
+        with self.wake_lock:
+            self.woken = False
+        redraw = False
+        try:
+            #a burst of commands costs a single frame
+            while True:
+                redraw = self.handle(self.commands.get_nowait()) or redraw
+        except queue.Empty:
+            pass
+
+        start = time.perf_counter()
+        try:
+            if redraw:
+                self.draw_frame()
+            elif not self.draw_animation():
+                start = None
+            self.overlay.refresh(self.screen)
+        except Exception as e:
+            self.logger.info('Render failed: {}'.format(e))
+        if start is not None:
+            self.record_frame(time.perf_counter() - start)
+
+    def record_frame(self, seconds):
+        with self.stats_lock:
+            self.frames_drawn += 1
+            self.frame_seconds += seconds
+            self.last_frame_seconds = seconds
+            self.max_frame_seconds = max(self.max_frame_seconds, seconds)
@@ -0,0 +1,118 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class RenditionCache(object):
+    '''Screen fitted renditions of images kept on disk across restarts.
+    Files are named by a hash of the source identity and target size, and the least
+    recently used ones are evicted once the cache grows past max_bytes.'''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger('main_logger')
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> size in bytes, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.exists(cache_dir):
+            os.mkdir(cache_dir)
+        self.load_index()
+
+    def load_index(self):
+        #mtime is bumped on every hit so it doubles as the recency order after a restart
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                #left behind by a write that never finished
+                os.unlink(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for mtime, name, size in sorted(entries):
+            self.entries[name] = size
+            self.total_bytes += size
+
+        with self.lock:
+            self.evict()
+
+    @staticmethod
+    def make_key(image_path, image_size, *variant):
+        stat = os.stat(image_path)
+        identity = '{}:{}:{}:{}x{}'.format(os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, *image_size)
+        for v in variant:
+            identity += ':{}'.format(v)
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key):
+        '''Return the path of the rendition stored under key or None'''
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+        return path
+
+    def store(self, key, write):
+        '''Call write(file) to produce the rendition for key. The file only appears
+        under its final name once it has been completely written.'''
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                write(tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        size = os.stat(self.path(key)).st_size
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.total_bytes += size
+            self.evict()
+
+        return self.path(key)
+
+    def evict(self):
+        #caller holds self.lock. The newest entry always stays, even if it alone is over budget
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self.path(key))
+            except OSError as e:
+                self.logger.info(e)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
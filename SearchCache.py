@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SearchCache(object):
+    '''Custom Search result pages kept in sqlite across restarts, keyed by
+    (term, image size, start index), along with where each term+size search left off.
+    Every page is committed as soon as it arrives so a crash loses nothing, and pages
+    older than ttl seconds are fetched again rather than served.
+    Images deleted from disk are remembered for ttl seconds too, and their links are
+    left out of cached pages so they are not downloaded straight back.'''
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        #autocommit: each write is its own transaction
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS pages
+                           (term TEXT, size TEXT, start INTEGER, fetched REAL, next_start INTEGER, links TEXT,
+                            PRIMARY KEY (term, size, start))''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS cursors
+                           (term TEXT, size TEXT, next_start INTEGER, PRIMARY KEY (term, size))''')
+        #images are named by the sha1 of their url, so that is what a dropped one is known by
+        self.db.execute('''CREATE TABLE IF NOT EXISTS dropped
+                           (term TEXT, name TEXT, dropped REAL, PRIMARY KEY (term, name))''')
+        self.hits = 0
+        self.misses = 0
+
+    def get_page(self, term, size, start):
+        '''(links, next_start) of a fresh cached page, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT links, next_start FROM pages WHERE term=? AND size=? AND start=? AND fetched>?',
+                                  (term, size, start, time.time() - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return self.without_dropped(term, json.loads(row[0])), row[1]
+
+    def put_page(self, term, size, start, links, next_start):
+        '''next_start is None when the API has no further pages'''
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                            (term, size, start, time.time(), next_start, json.dumps(links)))
+
+    def seen_links(self, term, size, before):
+        '''Links of the fresh cached pages a search has already gone past'''
+        with self.lock:
+            rows = self.db.execute('SELECT links FROM pages WHERE term=? AND size=? AND start<? AND fetched>? ORDER BY start',
+                                   (term, size, before, time.time() - self.ttl)).fetchall()
+        return self.without_dropped(term, [link for row in rows for link in json.loads(row[0])])
+
+    def without_dropped(self, term, links):
+        with self.lock:
+            dropped = {name for (name,) in self.db.execute('SELECT name FROM dropped WHERE term=?', (term,))}
+        if not dropped:
+            return links
+        return [link for link in links if hashlib.sha1(link.encode('utf-8')).hexdigest() not in dropped]
+
+    def drop(self, paths):
+        '''Leave the links of the images at paths (images/term/sha1 of url) out of cached pages'''
+        now = time.time()
+        rows = [(os.path.basename(os.path.dirname(path)), os.path.basename(path), now) for path in paths]
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO dropped VALUES (?, ?, ?)', rows)
+            self.db.execute('COMMIT')
+
+    def cursor(self, term, size):
+        '''Start index of the next page to search for term at size'''
+        with self.lock:
+            row = self.db.execute('SELECT next_start FROM cursors WHERE term=? AND size=?', (term, size)).fetchone()
+        return row[0] if row else 1
+
+    def set_cursor(self, term, size, next_start):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)', (term, size, next_start))
+
+    def import_cursors(self, query_cache, sizes):
+        '''Take over the start indexes of the old query cache, keyed by term+size'''
+        for key, next_start in query_cache.items():
+            for size in sizes:
+                if key.endswith(size):
+                    self.set_cursor(key[:-len(size)], size, next_start)
+                    break
+
+    def expire(self):
+        with self.lock:
+            self.db.execute('DELETE FROM pages WHERE fetched<=?', (time.time() - self.ttl,))
+            #by now every page that held them has expired as well
+            self.db.execute('DELETE FROM dropped WHERE dropped<=?', (time.time() - self.ttl,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        with self.lock:
+            pages = self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            dropped = self.db.execute('SELECT COUNT(*) FROM dropped').fetchone()[0]
+            return {'pages': pages,
+                    'dropped_images': dropped,
+                    'hits': self.hits,
+                    'misses': self.misses}
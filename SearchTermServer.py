@@ -1,18 +1,37 @@
+import asyncio
+import functools
 import logging
 import os
 import pprint
 import shutil
+import socket
 import threading
+import time
+from collections import OrderedDict
 
-from socketserver import ThreadingTCPServer, StreamRequestHandler
+from ImageCatalog import ImageCatalog
 from ImageCleaner import ImageCleaner
+from Job import Job
+from JsonSession import JsonSession
 from config import vars, TYPE_RESOLUTION
 
 
-class SearchTermServer(ThreadingTCPServer):
-    def __init__(self, image_dir, image_set, image_lock, max_file_age, refresh_event, daemon=True):
+class SearchTermServer(object):
+    '''The control server on localhost:9999, run on an asyncio event loop by serve_forever().
+    Connections are coroutines, so any number of clients cost no threads. Anything that
+    touches the disk or takes locks runs on a worker thread, and slow commands run as
+    jobs that clients can leave running, poll or follow, so no request can hold up another.'''
 
-        super().__init__(('localhost', 9999), TCPHandler, bind_and_activate=True)
+    MAX_JOBS = 50 # finished jobs kept around for ^jobs
+    SNAPSHOT_SECONDS = 300 # how long a paged listing's cursor stays good
+    MAX_SNAPSHOTS = 20
+
+    def __init__(self, image_dir, image_set, image_lock, max_file_age, refresh_event, catalog, daemon=True):
+
+        #bind straight away like socketserver did, so a busy port fails at startup
+        self.socket = socket.create_server(('localhost', 9999))
+        self.loop = None
+        self.stopped = None
         self.image_directory = image_dir
         self.max_file_age = max_file_age
         self.logger = logging.getLogger("main_logger")
@@ -20,12 +39,17 @@ class SearchTermServer(ThreadingTCPServer):
         self.images = image_set
         self.image_lock = image_lock
         self.refresh_event = refresh_event
+        self.catalog = catalog
         self.clean_event = threading.Event()
-        self.clean_result_event = threading.Event()
-        self.clean_msg_buffer = []
+        self.stats_sources = {}
+        self.jobs = OrderedDict() # id -> Job, oldest first
+        self.next_job_id = 1
+        self.snapshots_lock = threading.Lock()
+        self.snapshots = OrderedDict() # id -> (taken, items), oldest first
+        self.next_snapshot_id = 1
         self.image_clean_interval = 60*60*24
         self.image_cleaner = ImageCleaner(image_dir, image_lock, image_set, max_file_age, self.image_clean_interval,
-                                          self.clean_event, self.clean_result_event, self.clean_msg_buffer, self.refresh_event)
+                                          self.clean_event, self.refresh_event, catalog)
         self.image_cleaner.start()
 
         self.welcome_msg = '''Hello. Type ^commands for a list of commands'''
@@ -33,16 +57,57 @@ class SearchTermServer(ThreadingTCPServer):
         self.commands = {"^exit": "Exit.",
                          "^vars": "Modify runtime parameters. Syntax is: ^vars key:value key:value...",
                          "^space": "Show device disk space",
-                         "^clear": "Force an image clean event",
+                         "^clear": "Force an image clean event. ^clear dry only reports what would be erased. Runs as a job, add & to not wait for it",
                          "^idea": "Show how much space is taken up my images",
                          "^term": "Show search terms",
                          "^download": "Trigger a download event",
                          "^existing": "List existing image dirs",
                          "^ring": "List images currently being displayed",
                          "^extra": "Display existing images. Syntax: ^extra [-]term,...[-]term",
+                         "^stats": "Show counters such as cache hits/misses. Syntax: ^stats [name]",
+                         "^jobs": "List running and recent jobs",
+                         "^job": "Show a job's progress and result. Syntax: ^job id",
+                         "^wait": "Follow a job's progress until it is done. Syntax: ^wait id",
+                         "^json": "Switch to JSON lines, one request object (or array of them) per line",
                          "Add/remove vars":"Syntax[-]term,...,[-]term."
                          }
 
+    def register_stats(self, name, source):
+        '''source is a callable returning a dict of counters to show under ^stats'''
+        self.stats_sources[name] = source
+
+    def stats(self, name=None):
+        if name:
+            if name not in self.stats_sources:
+                raise KeyError("Unknown stats: {}. Try one of {}".format(name, sorted(self.stats_sources)))
+            return {name: self.stats_sources[name]()}
+        return {n: source() for n, source in self.stats_sources.items()}
+
+    def collect_stats(self, name=None):
+        try:
+            return pprint.pformat(self.stats(name))
+        except KeyError as e:
+            return e.args[0]
+
+    def take_snapshot(self, items):
+        '''Keep items for paging through, returns the id to find them by'''
+        with self.snapshots_lock:
+            now = time.time()
+            while self.snapshots and (len(self.snapshots) >= self.MAX_SNAPSHOTS or
+                                      next(iter(self.snapshots.values()))[0] < now - self.SNAPSHOT_SECONDS):
+                self.snapshots.popitem(last=False)
+            snapshot_id = str(self.next_snapshot_id)
+            self.next_snapshot_id += 1
+            self.snapshots[snapshot_id] = (now, items)
+            return snapshot_id
+
+    def snapshot(self, snapshot_id):
+        with self.snapshots_lock:
+            taken, items = self.snapshots.get(snapshot_id, (0, None))
+            if taken < time.time() - self.SNAPSHOT_SECONDS:
+                return None
+            return items
+
     def check_space(self):
         megs = 1024*1024
         gigs = megs*1024
@@ -64,50 +129,95 @@ class SearchTermServer(ThreadingTCPServer):
         return total, used, free
 
     def image_space_taken(self):
-        total_size = 0
         megs = 1024*1024.0
         gigs = megs*1024
-
-        for search_term in os.listdir(self.image_directory):
-            search_term_img_dir = os.path.join(self.image_directory, search_term)
-            if not os.path.isdir(search_term_img_dir):
-                continue
-            for img_file in os.listdir(search_term_img_dir):
-                file_path = os.path.join(search_term_img_dir, img_file)
-                file_size = os.stat(file_path).st_size
-                total_size += file_size
-
+        total_size = self.catalog.total_bytes()
         return total_size / megs, total_size / gigs
 
-    def format_delete_report(self, report):
+    def format_delete_report(self, dry_run, report):
         items = []
         days = 60*60*24
         for item in sorted(report, key=lambda i: i.filename):
-            items.append("{}, mtime (days):{:.2f}, space:{:.2f}kb".format(item.filename, item.age/days, item.space/1024))
+            items.append("{}, mtime (days):{:.2f}, space:{:.2f}kb, reason:{}".format(item.filename, item.age/days, item.space/1024, item.reason))
+        items.append("{} {} images, {:.2f}M".format("Would erase" if dry_run else "Erased", len(report),
+                                                   sum(item.space for item in report) / (1024*1024.0)))
         return '\r\n'.join(items)
 
 
-    def clear_oldies(self):
-        self.clean_event.set()
-        self.clean_result_event.wait()
-        self.clean_result_event.clear()
+    async def clear_oldies(self, dry_run, progress):
+        '''A ^clear job. Waits for the cleaner thread on the loop, so queued cleans hold up no worker thread'''
+        report = await asyncio.wrap_future(self.image_cleaner.request(dry_run, progress))
+        return self.format_delete_report(dry_run, report)
+
+    def start_job(self, command, work):
+        '''Run the coroutine work(progress) as a job. work may call progress(line) from
+        any thread to report how it is getting on, and returns the job's result.
+        Blocking work belongs on another thread, awaited from work.'''
+        job = Job(self.next_job_id, command)
+        self.next_job_id += 1
+        self.jobs[job.id] = job
+        finished = [j for j in self.jobs.values() if j.done]
+        for old in finished[:max(0, len(finished) - self.MAX_JOBS)]:
+            del self.jobs[old.id]
+
+        def progress(line):
+            self.loop.call_soon_threadsafe(job.progress, line)
 
-        if self.clean_msg_buffer:
-            return self.format_delete_report(self.clean_msg_buffer.pop())
+        async def run():
+            try:
+                job.finish(await work(progress))
+            except Exception as e:
+                self.logger.info('Job {} failed: {}'.format(command, e))
+                job.finish(error=e)
+
+        job.task = self.loop.create_task(run())
+        return job
+
+    def find_job(self, data):
+        try:
+            return self.jobs.get(int(data.split()[1]))
+        except (IndexError, ValueError):
+            return None
+
+    async def run_blocking(self, function, *args):
+        return await self.loop.run_in_executor(None, functools.partial(function, *args))
+
+    async def handle_client(self, reader, writer):
+        await ControlSession(self, reader, writer).handle()
+
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client, sock=self.socket)
+        async with server:
+            await self.stopped.wait()
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.serve())
+
+    def shutdown(self):
+        '''Stop serve_forever(). Safe to call from any thread.'''
+        if self.loop is not None and self.stopped is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
 
     def add_extra_images(self, data):
         tokens = data.partition("^extra")[-1].split(",")
         extra_imgs = set(vars['extra_images'])
         to_remove = set()
         to_add = set()
+        gone = set()
 
         for t in tokens:
             t = t.strip()
-            try:
-                term_dir = os.path.join(self.image_directory, t[1:] if t.startswith('-') else t)
-                imgs = os.listdir(term_dir)
-                imgs = map(lambda img: os.path.join(term_dir, img), imgs)
-            except FileNotFoundError:
+            term = t[1:] if t.startswith('-') else t
+            if not term or os.path.basename(term) != term:
+                continue
+            #images may have been copied into or deleted from the term dir by hand
+            added, removed = self.catalog.sync(self.image_dir, [term])
+            gone.update(removed)
+            imgs = self.catalog.paths([term])
+            if not imgs:
                 continue
 
             if t.startswith('-'):
@@ -122,22 +232,29 @@ class SearchTermServer(ThreadingTCPServer):
                 to_add.update(imgs)
 
         self.image_lock.acquire()
-        for i in self.images & to_remove:
+        for i in self.images & (to_remove | gone):
             self.images.remove(i)
         self.images.update(to_add)
         self.image_lock.release()
 
         vars['extra_images'] = extra_imgs
-        if to_remove or to_add:
+        if to_remove or to_add or gone:
             self.refresh_event.set()
 
         return extra_imgs
 
 
-class TCPHandler(StreamRequestHandler):
+class ControlSession(object):
+    '''One client connection, speaking the line based text protocol'''
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
 
-    def send_response(self, str):
-        self.wfile.write(bytes("{}\n".format(str),'utf8'))
+    async def send_response(self, str):
+        self.writer.write(bytes("{}\n".format(str),'utf8'))
+        await self.writer.drain()
 
     def list_vars(self):
         return pprint.pformat(vars)
@@ -154,71 +271,121 @@ class TCPHandler(StreamRequestHandler):
         return self.list_vars()
 
     def list_img_dirs(self):
-        terms = os.listdir(self.server.image_directory)
-        self.send_response(pprint.pformat(terms))
+        return pprint.pformat(os.listdir(self.server.image_directory))
+
+    def ring(self):
+        with self.server.image_lock:
+            return pprint.pformat(list(self.server.images))
+
+    def idea(self):
+        megs, gigs = self.server.image_space_taken()
+        lines = ["Space used: {:.2f}G {:.2f}M".format(gigs, megs)]
+        if 'ingest' in self.server.stats_sources:
+            ingest = self.server.stats_sources['ingest']()
+            lines.append("Saved by normalizing {} images: {:.2f}M".format(ingest['images'], ingest['saved_bytes'] / (1024*1024.0)))
+        return '\n'.join(lines)
+
+    def change_terms(self, data):
+        terms_copy = set(vars['search_terms'])
+        added_or_removed = False
+        user_terms = map(str.strip, data.split(','))
+
+        for term in user_terms:
+            if term.startswith("-"):
+                try:
+                    terms_copy.remove(term[1:])
+                    added_or_removed = True
+                except KeyError:
+                    pass
+            else:
+                terms_copy.add(term)
+                added_or_removed = True
+
+        if added_or_removed == True:
+            vars['search_terms'] = terms_copy
+            self.server.new_term_event.set()
+            return terms_copy
+
+    async def follow_job(self, job):
+        async for line in job.follow():
+            await self.send_response(line)
+
+    async def clear(self, data):
+        words = data.split()
+        dry_run = "dry" in words
+        job = self.server.start_job(data, functools.partial(self.server.clear_oldies, dry_run))
+        if "&" in words:
+            await self.send_response("Started job {}".format(job.id))
+        else:
+            await self.follow_job(job)
 
-    def parse_response(self):
+    async def parse_response(self):
+        run = self.server.run_blocking
         while self.data != "^exit":
 
             if self.data.startswith("^vars"):
-                self.send_response(self.modify_vars(self.data))
+                await self.send_response(await run(self.modify_vars, self.data))
             elif self.data == "^space":
-                total, used, free = self.server.check_space()
-                self.send_response("Total: {} Used: {} Free: {}".format(total, used, free))
-            elif self.data == "^clear":
-                self.wfile.write(b"Wait...")
-                self.send_response(self.server.clear_oldies())
+                total, used, free = await run(self.server.check_space)
+                await self.send_response("Total: {} Used: {} Free: {}".format(total, used, free))
+            elif self.data.startswith("^clear"):
+                await self.clear(self.data)
             elif self.data == "^idea":
-                self.wfile.write(b"Calculating... ")
-                megs, gigs = self.server.image_space_taken()
-                self.send_response("Space used: {:.2f}G {:.2f}M".format(gigs, megs))
+                await self.send_response(await run(self.idea))
             elif self.data == "^term":
-                self.send_response(vars['search_terms'])
+                await self.send_response(vars['search_terms'])
             elif self.data.startswith("^extra"):
-                self.send_response(pprint.pformat(self.server.add_extra_images(self.data)))
+                await self.send_response(pprint.pformat(await run(self.server.add_extra_images, self.data)))
             elif self.data == "^download":
                 # trigger a download event
                 self.server.new_term_event.set()
             elif self.data == "^ring":
-                current_displayed_images = pprint.pformat(self.server.images)
-                self.send_response(current_displayed_images)
+                await self.send_response(await run(self.ring))
+            elif self.data.startswith("^stats"):
+                await self.send_response(await run(self.server.collect_stats, self.data.partition("^stats")[-1].strip()))
             elif self.data == "^existing":
-                self.list_img_dirs()
+                await self.send_response(await run(self.list_img_dirs))
+            elif self.data == "^jobs":
+                await self.send_response('\r\n'.join(job.summary() for job in self.server.jobs.values()) or "No jobs")
+            elif self.data.startswith("^job ") or self.data.startswith("^wait "):
+                job = self.server.find_job(self.data)
+                if job is None:
+                    await self.send_response("Unknown job")
+                elif self.data.startswith("^wait"):
+                    await self.follow_job(job)
+                else:
+                    await self.send_response(job.describe())
+            elif self.data == "^json":
+                if not await JsonSession(self.server, self.reader, self.writer).handle():
+                    return
             elif self.data == "^commands":
-                self.send_response(pprint.pformat(self.server.commands))
+                await self.send_response(pprint.pformat(self.server.commands))
             else:
-                terms_copy = set(vars['search_terms'])
-                added_or_removed = False
-                user_terms = map(str.strip, self.data.split(','))
-
-                for term in user_terms:
-                    if term.startswith("-"):
-                        try:
-                            terms_copy.remove(term[1:])
-                            added_or_removed = True
-                        except KeyError:
-                            pass
-                    else:
-                        terms_copy.add(term)
-                        added_or_removed = True
-
-                if added_or_removed == True:
-                    vars['search_terms'] = terms_copy
-                    self.server.new_term_event.set()
-                    self.send_response(terms_copy)
-
-            self.wfile.write(bytes(":", 'utf-8'))
-            self.data = self.rfile.readline().strip().decode('utf-8')
-
-    def handle(self):
-        self.server.logger.info("{} connected".format(self.client_address))
-        self.send_response(self.server.welcome_msg)
-        self.send_response("Search terms: {}".format(vars['search_terms']))
-        self.wfile.write(b"\n:")
-
-        self.data = self.rfile.readline().strip().decode('utf-8')
-        self.parse_response()
-        self.send_response("Good bye.")
+                terms = self.change_terms(self.data)
+                if terms:
+                    await self.send_response(terms)
+
+            self.writer.write(bytes(":", 'utf-8'))
+            await self.writer.drain()
+            line = await self.reader.readline()
+            #an empty read means the client went away
+            self.data = line.strip().decode('utf-8') if line else "^exit"
+
+    async def handle(self):
+        self.server.logger.info("{} connected".format(self.writer.get_extra_info('peername')))
+        try:
+            await self.send_response(self.server.welcome_msg)
+            await self.send_response("Search terms: {}".format(vars['search_terms']))
+            self.writer.write(b"\n:")
+
+            line = await self.reader.readline()
+            self.data = line.strip().decode('utf-8') if line else "^exit"
+            await self.parse_response()
+            await self.send_response("Good bye.")
+        except (ConnectionError, UnicodeDecodeError) as e:
+            self.server.logger.info("Control connection dropped: {}".format(e))
+        finally:
+            self.writer.close()
 
 if __name__ == '__main__':
     CODE_DIR = os.path.dirname(__file__)
@@ -227,4 +394,5 @@ if __name__ == '__main__':
     image_lock = threading.Lock()
     refresh_event = threading.Event()
     MAX_FILE_AGE = 60 * 60 * 24 * 90
-    SearchTermServer(IMAGE_DIR, image_set, image_lock, MAX_FILE_AGE, refresh_event).serve_forever()
\ No newline at end of file
+    catalog = ImageCatalog(os.path.join(CODE_DIR, "catalog.sqlite"))
+    SearchTermServer(IMAGE_DIR, image_set, image_lock, MAX_FILE_AGE, refresh_event, catalog).serve_forever()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pygame
+from pygame import display
+
+
+class Transition(object):
+    '''Crossfades or slides from the frame on screen to the next one.
+    Both full screen buffers are allocated once, in the display's pixel format,
+    so a transition allocates nothing per frame.'''
+
+    KINDS = ('crossfade', 'slide')
+
+    def __init__(self, screen):
+        self.size = screen.get_size()
+        self.old = pygame.Surface(self.size).convert()
+        self.new = pygame.Surface(self.size).convert()
+        self.stats_lock = threading.Lock()
+        self.transitions = 0
+        self.last_fps = 0
+        self.total_frames = 0
+        self.total_seconds = 0
+
+    def run(self, screen, paint, kind, duration, fps):
+        '''paint(surface) draws the next frame. Blocks for about duration seconds.'''
+        self.old.blit(screen, (0,0))
+        paint(self.new)
+
+        width = self.size[0]
+        frames = max(1, int(duration * fps))
+        frame_time = 1.0 / fps
+        start = time.perf_counter()
+
+        for i in range(1, frames + 1):
+            progress = float(i) / frames
+            if kind == 'crossfade':
+                screen.blit(self.old, (0,0))
+                self.new.set_alpha(int(255 * progress))
+                screen.blit(self.new, (0,0))
+            else:
+                offset = int(width * progress)
+                screen.blit(self.old, (-offset, 0))
+                screen.blit(self.new, (width - offset, 0))
+            display.flip()
+
+            #hold the target frame rate, or fall behind it as little as possible
+            delay = start + i * frame_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        self.new.set_alpha(None)
+        self.record(frames, time.perf_counter() - start)
+
+    def record(self, frames, seconds):
+        with self.stats_lock:
+            self.transitions += 1
+            self.last_fps = frames / seconds
+            self.total_frames += frames
+            self.total_seconds += seconds
+
+    def stats(self):
+        with self.stats_lock:
+            return {'transitions': self.transitions,
+                    'last_fps': round(self.last_fps, 1),
+                    'avg_fps': round(self.total_frames / self.total_seconds, 1) if self.total_seconds else 0}
@@ -0,0 +1,45 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Transport(object):
+    '''The one HTTP session that searching and downloading share.
+    Connections are pooled and kept alive per host, and connection errors, 429s and
+    5xxs are retried with exponential backoff (backoff, 2*backoff, 4*backoff... seconds)
+    before the caller sees them.'''
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, user_agent, pool_size, retries, backoff):
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+
+        #raise_on_status=False hands back the last error response so callers raise_for_status() as before
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=self.RETRY_STATUSES,
+                      allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def get(self, url, timeout, **kwargs):
+        return self.session.get(url, timeout=timeout, **kwargs)
+
+    def stats(self):
+        #urllib3 counts the connections each host pool opened and the requests sent over them.
+        #Every request beyond the first on a connection reused it.
+        requests_sent = 0
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            requests_sent += pool.num_requests
+            connections += pool.num_connections
+
+        return {'host_pools': len(pools),
+                'requests': requests_sent,
+                'connections_opened': connections,
+                'connections_reused': requests_sent - connections}
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+FOREVER = float('inf')
+
+
+class BloomFilter(object):
+    '''Membership of 64 bit keys in about 10 bits per key at a 1% false positive rate.
+    Never says no to something that was added. Entries cannot be removed, so the
+    owner rebuilds it when it forgets entries.'''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1024, capacity)
+        self.bits = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / self.capacity * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        #double hashing: the two 32 bit halves of a 64 bit hash make all k positions
+        key &= 0xffffffffffffffff
+        h1 = key >> 32
+        h2 = (key & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+class UrlBlacklist(object):
+    '''Urls that failed to download, and until when to leave them alone.
+    Each failure doubles the time a url is skipped, starting at backoff seconds and
+    capped at max_backoff. Permanent failures (gone, not an image) are skipped for good.
+    Entries live in sqlite, keyed by a 64 bit hash of the url. Only a bloom filter of
+    the keys is kept in memory, about 10 bits an entry, so the common case of a url that
+    never failed is answered without touching the disk however many entries there are.'''
+
+    def __init__(self, path, backoff, max_backoff):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = logging.getLogger('main_logger')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        #until is NULL for urls skipped for good
+        self.db.execute('CREATE TABLE IF NOT EXISTS failures (key INTEGER PRIMARY KEY, failures INTEGER, until REAL)')
+        self.filter_hits = 0
+        self.false_positives = 0
+        self.skips = 0
+
+        with self.lock:
+            self.forget_old()
+
+    @staticmethod
+    def key(url):
+        #signed, to fit a sqlite integer
+        return int.from_bytes(hashlib.sha1(url.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+    def import_log(self, path):
+        '''Take over the entries of the old append only log. Lines are "key failures until",
+        a bare url is from the flat file before that and counts as one failure.'''
+        now = time.time()
+        rows = []
+        with open(path) as log:
+            for line in log:
+                fields = line.split()
+                if not fields:
+                    continue
+                try:
+                    if len(fields) == 3:
+                        until = float(fields[2])
+                        rows.append((int.from_bytes(bytes.fromhex(fields[0]), 'big', signed=True), int(fields[1]),
+                                     None if until == FOREVER else until))
+                    else:
+                        rows.append((self.key(fields[0]), 1, now + self.backoff))
+                except ValueError:
+                    self.logger.info('Skipping bad blacklist line: {}'.format(line.strip()))
+        with self.lock:
+            self.db.execute('BEGIN')
+            #later lines of the log win
+            self.db.executemany('INSERT OR REPLACE INTO failures VALUES (?, ?, ?)', rows)
+            self.db.execute('COMMIT')
+            self.rebuild_filter()
+        return len(rows)
+
+    def forget_old(self):
+        '''Caller holds self.lock'''
+        #once a url has been left alone for max_backoff past its expiry its failures are forgotten
+        self.db.execute('DELETE FROM failures WHERE until<=?', (time.time() - self.max_backoff,))
+        self.rebuild_filter()
+
+    def rebuild_filter(self):
+        #caller holds self.lock
+        count = self.db.execute('SELECT COUNT(*) FROM failures').fetchone()[0]
+        self.filter = BloomFilter(2 * count)
+        for (key,) in self.db.execute('SELECT key FROM failures'):
+            self.filter.add(key)
+
+    def __contains__(self, url):
+        '''True while url is being skipped'''
+        key = self.key(url)
+        with self.lock:
+            if key not in self.filter:
+                return False
+            self.filter_hits += 1
+            row = self.db.execute('SELECT until FROM failures WHERE key=?', (key,)).fetchone()
+            if row is None:
+                self.false_positives += 1
+                return False
+            if row[0] is not None and row[0] <= time.time():
+                return False
+            self.skips += 1
+            return True
+
+    def record_failure(self, url, permanent=False):
+        '''Skip url for longer each time it fails, or for good if permanent'''
+        key = self.key(url)
+        with self.lock:
+            row = self.db.execute('SELECT failures FROM failures WHERE key=?', (key,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            if permanent:
+                until = FOREVER
+            else:
+                until = time.time() + min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+            self.db.execute('INSERT OR REPLACE INTO failures VALUES (?, ?, ?)',
+                            (key, failures, None if until == FOREVER else until))
+
+            if row is None:
+                self.filter.add(key)
+                if self.filter.count > self.filter.capacity:
+                    self.forget_old()
+            return until
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        with self.lock:
+            entries, skipped, permanent = self.db.execute(
+                'SELECT COUNT(*), COUNT(CASE WHEN until IS NULL OR until>? THEN 1 END), COUNT(*) - COUNT(until) FROM failures',
+                (time.time(),)).fetchone()
+            return {'entries': entries,
+                    'skipped_now': skipped,
+                    'permanent': permanent,
+                    'filter_kb': len(self.filter.array) // 1024,
+                    'filter_hits': self.filter_hits,
+                    'false_positives': self.false_positives,
+                    'skips': self.skips}
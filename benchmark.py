@@ -0,0 +1,168 @@
+'''Benchmarks for the slow paths of the slide show. Meant to be run on the Pi itself.
+
+    python benchmark.py convert images/plants --width 1024 --height 768
+    python benchmark.py cpu $(pgrep -f display.py) --seconds 60 --label idle
+    python benchmark.py downloads --hosts 4 --urls 64 --latency .2
+'''
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pygame
+from PIL import Image
+
+import imageconvert
+from DownloadPool import DownloadPool
+
+
+def collect_images(directory):
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if not name.endswith('.log'):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+def report(name, timings, bytes_written=None):
+    if not timings:
+        print("{:>10}: no samples".format(name))
+        return
+
+    timings = sorted(timings)
+    line = "{:>10}: n={} mean={:.1f}ms median={:.1f}ms p95={:.1f}ms".format(
+        name, len(timings), statistics.mean(timings) * 1000, statistics.median(timings) * 1000,
+        timings[int(len(timings) * .95)] * 1000)
+    if bytes_written is not None:
+        line += " written={:.1f}kB/slide".format(bytes_written / 1024.0 / len(timings))
+    print(line)
+
+def tempfile_slide(image_path, image_size):
+    '''The old display path: fit, re-encode into a temp file, decode the temp file again'''
+    with Image.open(image_path) as pil_image:
+        image_format = pil_image.format
+    new_pil_image = imageconvert.fit_image(image_path, image_size)
+    conv_file = tempfile.NamedTemporaryFile(delete=False)
+    new_pil_image.save(conv_file, format=image_format)
+    conv_file.close()
+
+    bytes_written = os.path.getsize(conv_file.name)
+    surface = pygame.image.load(conv_file.name)
+    os.unlink(conv_file.name)
+    return surface, bytes_written
+
+def buffer_slide(image_path, image_size):
+    pil_image = imageconvert.fit_image(image_path, image_size)
+    return imageconvert.pil_to_surface(pil_image), 0
+
+def bench_convert(args):
+    paths = collect_images(args.directory)
+    image_size = (args.width, args.height)
+
+    for name, convert in (('tempfile', tempfile_slide), ('buffer', buffer_slide)):
+        timings = []
+        bytes_written = 0
+        for path in paths:
+            start = time.perf_counter()
+            try:
+                surface, written = convert(path, image_size)
+            except (IOError, ValueError, pygame.error):
+                continue
+            timings.append(time.perf_counter() - start)
+            bytes_written += written
+        report(name, timings, bytes_written)
+
+def process_cpu_seconds(pid):
+    #utime and stime are the 14th and 15th fields, counted after the parenthesised command name
+    with open('/proc/{}/stat'.format(pid)) as stat:
+        fields = stat.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def bench_cpu(args):
+    '''CPU use of a running display.py, e.g. once while idle and once on the loading screen'''
+    samples = []
+    previous = process_cpu_seconds(args.pid)
+    for i in range(int(args.seconds / args.interval)):
+        time.sleep(args.interval)
+        current = process_cpu_seconds(args.pid)
+        samples.append((current - previous) / args.interval)
+        previous = current
+
+    print("{:>10}: mean={:.1f}% max={:.1f}% over {}s".format(
+        args.label, statistics.mean(samples) * 100, max(samples) * 100, args.seconds))
+
+def start_stub_host(body, latency):
+    '''A local image host that answers every GET with body after latency seconds'''
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    return stub
+
+def fetch_url(url):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return len(response.read())
+
+def bench_downloads(args):
+    '''Throughput of DownloadPool against stub hosts, one port per host'''
+    body = os.urandom(args.size)
+    stubs = [start_stub_host(body, args.latency) for i in range(args.hosts)]
+    urls = ['http://127.0.0.1:{}/{}'.format(stubs[i % args.hosts].server_address[1], i) for i in range(args.urls)]
+
+    for workers in args.workers:
+        pool = DownloadPool(fetch_url, workers, args.per_host)
+        start = time.perf_counter()
+        for url in urls:
+            pool.add(url)
+        pool.close()
+        received = sum(result or 0 for job, result, error in pool.results())
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        print("{:>3} workers: {:.1f} urls/s {:.2f}MB/s".format(workers, len(urls) / elapsed, received / elapsed / 1024 / 1024))
+
+    for stub in stubs:
+        stub.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='per slide latency and bytes written of the image conversion paths')
+    convert_parser.add_argument('directory')
+    convert_parser.add_argument('--width', type=int, default=1920)
+    convert_parser.add_argument('--height', type=int, default=1080)
+    convert_parser.set_defaults(run=bench_convert)
+
+    cpu_parser = subparsers.add_parser('cpu', help='cpu use of a running slide show')
+    cpu_parser.add_argument('pid', type=int)
+    cpu_parser.add_argument('--seconds', type=float, default=30)
+    cpu_parser.add_argument('--interval', type=float, default=1)
+    cpu_parser.add_argument('--label', default='cpu')
+    cpu_parser.set_defaults(run=bench_cpu)
+
+    downloads_parser = subparsers.add_parser('downloads', help='download throughput against local stub hosts as concurrency grows')
+    downloads_parser.add_argument('--hosts', type=int, default=4)
+    downloads_parser.add_argument('--urls', type=int, default=64)
+    downloads_parser.add_argument('--size', type=int, default=256 * 1024, help='bytes per image')
+    downloads_parser.add_argument('--latency', type=float, default=.2, help='seconds before a stub host answers')
+    downloads_parser.add_argument('--per-host', type=int, default=2)
+    downloads_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    downloads_parser.set_defaults(run=bench_downloads)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -5,10 +5,94 @@ import json
 with open('config.json','r') as f:
     vars = json.load(f)
 
+#Settings that older config files may not have yet
+DEFAULTS = {'prefetch_depth': 2,
+            'rendition_cache_mb': 512,
+            'resample_filter': 'bicubic',
+            'play_animations': True,
+            'animation_max_frames': 300,
+            'animation_max_mb': 64,
+            'progress_max_fps': 4,
+            'transition': 'none',
+            'transition_seconds': .5,
+            'transition_fps': 30,
+            'download_workers': 4,
+            'downloads_per_host': 2,
+            'download_timeout': 30,
+            'search_timeout': 15,
+            'http_retries': 3,
+            'http_backoff': .5,
+            'search_workers': 2,
+            'pipeline_queue_size': 20,
+            'ingest_normalize': False,
+            'ingest_quality': 85,
+            'keep_originals': False,
+            'max_download_mb': 20,
+            'search_cache_days': 7,
+            'blacklist_backoff_hours': 1,
+            'blacklist_max_days': 30,
+            'skip_near_duplicates': True,
+            'near_duplicate_bits': 6,
+            'download_bytes_per_sec': 0,
+            'api_requests_per_sec': 0,
+            'api_daily_quota': 0,
+            'api_calls_per_refresh': 0,
+            'term_weights': {},
+            'image_budget_mb': 0,
+            'term_quota_mb': 0,
+            'min_free_mb': 0,
+            'eviction_policy': 'lru',
+            'clean_batch_size': 100}
+
+for key, value in DEFAULTS.items():
+    vars.setdefault(key, value)
+
+def to_bool(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def to_weights(value):
+    #term=weight,term=weight
+    weights = {}
+    for pair in value.split(','):
+        term, _, weight = pair.partition('=')
+        if term.strip():
+            weights[term.strip()] = float(weight)
+    return weights
 
 TYPE_RESOLUTION = {'image_download_interval': int,
                    'flip_frequency': int,
-                   'results_per_page': int}
+                   'results_per_page': int,
+                   'prefetch_depth': int,
+                   'play_animations': to_bool,
+                   'animation_max_frames': int,
+                   'animation_max_mb': int,
+                   'progress_max_fps': float,
+                   'transition_seconds': float,
+                   'transition_fps': float,
+                   'download_workers': int,
+                   'downloads_per_host': int,
+                   'download_timeout': float,
+                   'search_timeout': float,
+                   'search_workers': int,
+                   'pipeline_queue_size': int,
+                   'ingest_normalize': to_bool,
+                   'ingest_quality': int,
+                   'keep_originals': to_bool,
+                   'max_download_mb': float,
+                   'search_cache_days': float,
+                   'blacklist_backoff_hours': float,
+                   'blacklist_max_days': float,
+                   'skip_near_duplicates': to_bool,
+                   'near_duplicate_bits': int,
+                   'download_bytes_per_sec': int,
+                   'api_requests_per_sec': float,
+                   'api_daily_quota': int,
+                   'api_calls_per_refresh': int,
+                   'term_weights': to_weights,
+                   'image_budget_mb': float,
+                   'term_quota_mb': float,
+                   'min_free_mb': float,
+                   'clean_batch_size': int}
 
 def save_config():
     vars['search_terms'] = list(vars['search_terms'])
@@ -2,21 +2,43 @@
 Handles downloading, converting, and displaying images.
 Images are chosen based on fixed search terms'''
 
-import pygame, os, tempfile, random
-import urllib, urllib.request, urllib.error, urllib.parse
-import threading, time, datetime, re
+import pygame, os, random
+import urllib, urllib.parse
+import threading, re
 import hashlib
 import signal
 import sys
+import time
 import requests
 import logging
 import pickle
+import json
+import tempfile
+import shutil
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import config
+import imageconvert
+import AnimationStore
+from AnimationStore import Animation, AnimationTooLarge
 from GIFImage import GIFImage
-from pygame import display, image, Rect
+from pygame import display
 from PIL import Image
+from DownloadPool import DownloadPool
+from ImageCatalog import ImageCatalog
 from ImageDownloader import ImageDownloader
+from ImagePrefetcher import ImagePrefetcher
+from Playlist import Playlist
+from Transport import Transport
+from ProgressOverlay import ProgressOverlay
+from Renderer import Renderer
+from RenditionCache import RenditionCache
+from ContentIndex import ContentIndex
+from QueryPlanner import QueryPlanner
+from RateLimiter import RateLimiter
+from SearchCache import SearchCache
+from UrlBlacklist import UrlBlacklist
 from SearchTermServer import SearchTermServer
 from config import vars
 
@@ -43,8 +65,10 @@ if not os.path.exists(IMAGE_DIR): os.mkdir(IMAGE_DIR)
 #This path should exist already with loading images that come with the program
 LOAD_IMAGE_DIR = os.path.join(CODE_DIR, "loading_imgs")
 
-#currently the conversion cache never expires while this program is running.
-CONVERT_CACHE = {}
+#Screen fitted copies of images. Survives restarts and evicts the least recently shown.
+RENDITION_DIR = os.path.join(CODE_DIR, "renditions")
+RENDITION_CACHE = RenditionCache(RENDITION_DIR, vars['rendition_cache_mb'] * 1024 * 1024)
+
 display.init()
 
 highest_res = display.list_modes()[0]
@@ -74,28 +98,65 @@ USER_AGENT = vars['user_agent']
 API_KEY = vars['api_key']
 
 IMAGES_LOCK = threading.Lock()
+#pooled keep-alive connections for both the search API and image hosts
+TRANSPORT = Transport(USER_AGENT, max(10, vars['download_workers']), vars['http_retries'], vars['http_backoff'])
 IMAGE_SIZES = [
     'xlarge',
     'xxlarge',
     'huge'
 ]
-IMAGE_BLACKLIST_FILENAME = os.path.join(CODE_DIR,"urlblacklist")
+IMAGE_BLACKLIST_FILENAME = os.path.join(CODE_DIR,"urlblacklist.sqlite")
 MAX_FILE_AGE = 60 * 60 * 24 * 90 # 90 days
 SHOW_IMAGE_POSITION = False
 
-try:
-    with open("qc.pickle", "rb") as qc_pickle_file:
-        QUERY_CACHE = pickle.load(qc_pickle_file)
-except (pickle.UnpicklingError, FileNotFoundError, TypeError):
-    QUERY_CACHE = {} #key = query, value = search result page index
+#search result pages and where each term+size search left off, kept across restarts
+SEARCH_CACHE = SearchCache(os.path.join(CODE_DIR, "searchcache.sqlite"), vars['search_cache_days'] * 60 * 60 * 24)
+SEARCH_CACHE.expire()
+QUERY_CACHE_FILENAME = "qc.pickle"
 
-SCREEN_LOCK = threading.Lock()
+if os.path.exists(QUERY_CACHE_FILENAME):
+    #the old query cache only had start indexes, which carry over as cursors
+    try:
+        with open(QUERY_CACHE_FILENAME, "rb") as qc_pickle_file:
+            SEARCH_CACHE.import_cursors(pickle.load(qc_pickle_file), IMAGE_SIZES)
+        os.unlink(QUERY_CACHE_FILENAME)
+    except (pickle.UnpicklingError, TypeError, EOFError) as e:
+        main_logger.info('Could not import query cache: {}'.format(e))
+
+#Downloads are normalized to screen size at ingest. Originals are kept here when keep_originals is set.
+ORIGINALS_DIR = os.path.join(CODE_DIR, "originals")
+#files still being written live here until they are complete, never among the images.
+#Anything left from a run that was cut off is thrown away.
+PARTIAL_DIR = os.path.join(CODE_DIR, "partial")
+PARTIAL_SUFFIX = '.part'
+shutil.rmtree(PARTIAL_DIR, ignore_errors=True)
+os.mkdir(PARTIAL_DIR)
+INGEST_STATS_FILENAME = os.path.join(CODE_DIR, "ingest.json")
+INGEST_LOCK = threading.Lock()
 
 try:
-    with open(IMAGE_BLACKLIST_FILENAME) as blacklist:
-        IMAGE_BLACKLIST = {url.strip() for url in blacklist.readlines()}
-except IOError:
-    IMAGE_BLACKLIST = {}
+    with open(INGEST_STATS_FILENAME) as ingest_stats_file:
+        INGEST_STATS = json.load(ingest_stats_file)
+except (IOError, ValueError):
+    INGEST_STATS = {'images': 0, 'original_bytes': 0, 'stored_bytes': 0}
+
+#failed urls are skipped for a while, longer each time, or for good once they are known to be useless
+IMAGE_BLACKLIST = UrlBlacklist(IMAGE_BLACKLIST_FILENAME, vars['blacklist_backoff_hours'] * 60 * 60,
+                               vars['blacklist_max_days'] * 60 * 60 * 24)
+IMAGE_BLACKLIST_LOG = os.path.join(CODE_DIR,"urlblacklist")
+if os.path.exists(IMAGE_BLACKLIST_LOG):
+    #the blacklist used to be a text file, kept in memory
+    main_logger.info('Imported {} blacklisted urls'.format(IMAGE_BLACKLIST.import_log(IMAGE_BLACKLIST_LOG)))
+    os.unlink(IMAGE_BLACKLIST_LOG)
+#responses that will not change however often we retry
+PERMANENT_HTTP_ERRORS = (404, 410)
+#keeps background downloading from hogging the network and SD card
+RATE_LIMITER = RateLimiter(lambda: vars['download_bytes_per_sec'], lambda: vars['api_requests_per_sec'],
+                           lambda: vars['api_daily_quota'], os.path.join(CODE_DIR, "apiquota.json"))
+#spreads search API calls over terms and image sizes by how many new images each turns up
+PLANNER = QueryPlanner(os.path.join(CODE_DIR, "planner.json"), RESULTS_PER_PAGE)
+#what each downloaded file holds, to store every picture once and spot near duplicates
+CONTENT_INDEX = ContentIndex(os.path.join(CODE_DIR, "contentindex.sqlite"))
 
 
 def assemble_query(query, img_size, index=1):
@@ -114,24 +175,48 @@ def assemble_query(query, img_size, index=1):
     return GOOGLE_API_URL.format(urllib.parse.urlencode(parameters))
 
 def assemble_images():
-    images = set()
-    for term in vars['search_terms'] + vars['extra_images']:
-        img_dir = os.path.join(IMAGE_DIR, term)
-
-        if not os.path.exists(img_dir):
-            continue
-
-        for img in os.listdir(img_dir):
-            if img.endswith('.log'):
-                continue
-            img_full_path = os.path.join(img_dir, img)
-            images.add(img_full_path)
-
-    return images
-
-IMAGES = assemble_images()
-REFRESH_EVENT = threading.Event()
-server = SearchTermServer(IMAGE_DIR, IMAGES, IMAGES_LOCK, MAX_FILE_AGE, REFRESH_EVENT)
+    return CATALOG.paths(vars['search_terms'] + vars['extra_images'])
+
+#every image on disk, so nothing has to walk images/ to find or measure them
+CATALOG = ImageCatalog(os.path.join(CODE_DIR, "catalog.sqlite"))
+#deleted images stay deleted, rather than come back from a cached search page
+CATALOG.on_remove(SEARCH_CACHE.drop)
+#pick up images copied in or deleted by hand while we were not running
+added, removed = CATALOG.sync(IMAGE_DIR)
+for path in removed:
+    CONTENT_INDEX.remove(path)
+main_logger.info('Catalog sync: {} images added, {} gone'.format(len(added), len(removed)))
+#shuffled, weighted by term_weights, and safe to share with the downloader and server
+IMAGES = Playlist(assemble_images(), lambda: vars['term_weights'])
+#custom pygame events the main loop sleeps on
+FLIP_EVENT = pygame.USEREVENT + 1
+IMAGES_CHANGED_EVENT = pygame.USEREVENT + 2
+#something was queued for the renderer, which draws on the main thread
+RENDER_EVENT = pygame.USEREVENT + 3
+
+def notify_images_changed():
+    #pygame.event.post is safe to call from any thread
+    pygame.event.post(pygame.event.Event(IMAGES_CHANGED_EVENT))
+
+class RefreshEvent(threading.Event):
+    '''threading.Event that also wakes the main loop out of pygame.event.wait()'''
+    def set(self):
+        super().set()
+        notify_images_changed()
+
+REFRESH_EVENT = RefreshEvent()
+server = SearchTermServer(IMAGE_DIR, IMAGES, IMAGES_LOCK, MAX_FILE_AGE, REFRESH_EVENT, CATALOG)
+server.register_stats('rendition_cache', RENDITION_CACHE.stats)
+server.register_stats('transport', TRANSPORT.stats)
+server.register_stats('search_cache', SEARCH_CACHE.stats)
+server.register_stats('blacklist', IMAGE_BLACKLIST.stats)
+server.register_stats('content_index', CONTENT_INDEX.stats)
+server.register_stats('rate_limits', RATE_LIMITER.stats)
+server.register_stats('planner', PLANNER.stats)
+server.register_stats('catalog', CATALOG.stats)
+
+OVERLAY = ProgressOverlay(IMAGE_SIZE, LOADING_FONT, LOADING_FONT_DETAILED, RGB_BLACK, TEXT_PADDING)
+server.register_stats('progress_overlay', OVERLAY.stats)
 
 def get_center_width_offset(pil_image):
     iwidth = pil_image.size[0]
@@ -141,254 +226,388 @@ def get_center_height_offset(pil_image):
     iheight = pil_image.size[1]
     return (SCREEN_HEIGHT - iheight) / 2
 
-def pil_image_convert(image_path):
-    try:
-        #will need to close this one
-        return Image.open(CONVERT_CACHE[image_path]),True
-    except KeyError:
-        pil_image = Image.open(image_path)
-        #no need to close this, as pil does it automatically during resize_image()
-
-        new_pil_image = resize_image(pil_image)
-        conv_filepath = tempfile.NamedTemporaryFile(delete=False)
-        new_pil_image.save(conv_filepath, format=pil_image.format)
-        conv_filepath.close()
-        CONVERT_CACHE[image_path] = conv_filepath.name
-
-        #don't need to close this image, PIL has not allocated a FP
-        return new_pil_image,False
+#animation is None for still images
+Slide = namedtuple('Slide', ['surface', 'position', 'animation'], defaults=(None,))
 
-def resize_image(pil_image):
-    #pil wil close pil_image automatically when thumbnail or resize() is called
-    #the returned image does not have a file pointer so close() wont work on it either
-    width = pil_image.size[0]
-    height = pil_image.size[1]
+def load_animation(image_path, resample):
+    key = RenditionCache.make_key(image_path, IMAGE_SIZE, resample, 'animation2')
+    frame_path = RENDITION_CACHE.lookup(key)
 
-    if width > SCREEN_WIDTH or height > SCREEN_HEIGHT:
-        #Shrink image to screen size
-        pil_image.thumbnail(IMAGE_SIZE)
-        return pil_image
+    if not frame_path:
+        max_bytes = vars['animation_max_mb'] * 1024 * 1024
+        frame_path = RENDITION_CACHE.store(key, lambda fp: AnimationStore.write_frames(
+            image_path, IMAGE_SIZE, fp, vars['animation_max_frames'], max_bytes, resample))
 
-    width_to_screen_ratio = float(SCREEN_WIDTH) / width
-    height_to_screen_ratio = float(SCREEN_HEIGHT) / height
+    animation = Animation(frame_path)
+    coordinate_x = get_center_width_offset(animation)
+    coordinate_y = get_center_height_offset(animation)
 
-    ratio_increase = min(width_to_screen_ratio, height_to_screen_ratio)
+    #later frames are views over the frame file and are blitted as they are.
+    #The renderer converts the first to the display format.
+    return Slide(animation.surface(0), (coordinate_x, coordinate_y), animation)
 
-    new_width = int(float(width) * ratio_increase)
-    new_height = int(float(height) * ratio_increase)
-
-    #Or we return an aspect ratio preserved enlarged image to screen size
-    return pil_image.resize((new_width, new_height))
-
-
-def display_image(image_path, image_index):
-    pil_image,cache_hit = pil_image_convert(image_path)
+def load_slide(image_path):
+    '''Decode and fit an image to the screen. Safe to call off the main thread.'''
+    resample = vars['resample_filter']
 
+    if vars['play_animations'] and AnimationStore.is_animated(image_path):
+        try:
+            return load_animation(image_path, resample)
+        except AnimationTooLarge as e:
+            main_logger.info('Showing the first frame only: {}'.format(e))
+
+    pil_image = Image.open(image_path)
+    if imageconvert.fit_size(pil_image.size, IMAGE_SIZE) == pil_image.size:
+        #already screen sized, e.g. normalized at ingest, so there is nothing to fit or cache
+        pil_image.load()
+        return make_still_slide(pil_image)
+    pil_image.close()
+
+    key = RenditionCache.make_key(image_path, IMAGE_SIZE, resample)
+    rendition_path = RENDITION_CACHE.lookup(key)
+
+    if rendition_path:
+        pil_image = Image.open(rendition_path)
+        #load() closes the file pointer
+        pil_image.load()
+    else:
+        pil_image = imageconvert.fit_image(image_path, IMAGE_SIZE, resample)
+        RENDITION_CACHE.store(key, lambda fp: imageconvert.save_rendition(pil_image, fp))
+
+    return make_still_slide(pil_image)
+
+def make_still_slide(pil_image):
     coordinate_x = get_center_width_offset(pil_image)
     coordinate_y = get_center_height_offset(pil_image)
 
-    if cache_hit:
-        pil_image.close()
-
-    surface_img = image.load(CONVERT_CACHE[image_path])
-
-    SCREEN_LOCK.acquire()
-    screen.fill(RGB_BLACK)
-    screen.blit(surface_img, (coordinate_x, coordinate_y))
-    if SHOW_IMAGE_POSITION:
-        display_image_position(image_index)
-    display.flip()
-    SCREEN_LOCK.release()
+    #the renderer converts it to the display format on the main thread
+    return Slide(imageconvert.pil_to_surface(pil_image), (coordinate_x, coordinate_y))
 
-def display_image_position(image_index):
-    position = "{}/{}".format(image_index+1, len(IMAGES))
-    text = LOADING_FONT_DETAILED.render(position, 1, FONT_COLOR)
-    screen.blit(text, (0,0))
+def display_image(slide, image_index):
+    RENDERER.show_slide(slide, image_index, len(IMAGES))
 
 
-def search_for_images(search_term, img_sizes, num_urls_desired=RESULTS_PER_PAGE):
+def search_for_images(search_term, img_sizes, num_urls_desired=RESULTS_PER_PAGE, urls=None, wrapped=False):
+    '''Yields new image urls for search_term as each page of results comes back.
+    Links already in SEARCH_CACHE are used up before any quota is spent on the API.'''
 
     term_logger = setup_term_logger(search_term)
-    urls = set()
+    if urls is None:
+        urls = set()
 
     #return if there are no more image sizes to try the search term against
     if not img_sizes:
         term_logger.info("Ran out of images to search for {}".format(search_term))
-        return urls
+        return
+
+    def wanted(link):
+        #filter out x-raw-image:// urls, and anything already downloaded or handed out
+        if not re.match('^https?://', link) or link in urls or link in IMAGE_BLACKLIST:
+            return False
+        filename_hash = hashlib.sha1(link.encode('utf-8')).hexdigest()
+        if os.path.join(IMAGE_DIR, search_term, filename_hash) in IMAGES:
+            return False
+        #a duplicate of a picture the term already has, under another file name
+        return not CONTENT_INDEX.has_url_in(link, os.path.join(IMAGE_DIR, search_term))
 
     urls_found = 0
     img_size = img_sizes[0]
-    next_start_index = QUERY_CACHE.get(search_term+img_size, 1)
+    next_start_index = SEARCH_CACHE.cursor(search_term, img_size)
+
+    #links on pages we already went past but stopped short of using
+    for link in SEARCH_CACHE.seen_links(search_term, img_size, next_start_index):
+        if urls_found == num_urls_desired:
+            return
+        if wanted(link):
+            urls.add(link)
+            urls_found += 1
+            term_logger.info("Found cached {} {}".format(link, img_size))
+            yield link
 
     while urls_found < num_urls_desired:
         # API only returns a maximum of 100 results
-        if next_start_index + RESULTS_PER_PAGE > 100:
-            # if we have exhausted searching every image size, clear the cache and start again
-            if len(img_sizes) == 1:
-                for img_s in IMAGE_SIZES:
-                    QUERY_CACHE[search_term + img_s] = 1
-            else:
-                # otherwise, try another image size
-                return urls.union(search_for_images(search_term, img_sizes[1:], num_urls_desired - len(urls)))
-
-        query_url = assemble_query(search_term, img_size, next_start_index)
+        if next_start_index is None or next_start_index + RESULTS_PER_PAGE > 100:
+            if len(img_sizes) > 1:
+                # try another image size
+                yield from search_for_images(search_term, img_sizes[1:], num_urls_desired - urls_found, urls, wrapped)
+                return
+            if wrapped:
+                term_logger.info("Every page for {} has been searched".format(search_term))
+                return
+            # we have exhausted searching every image size, start again from the first page
+            for img_s in IMAGE_SIZES:
+                SEARCH_CACHE.set_cursor(search_term, img_s, 1)
+            wrapped = True
+            next_start_index = 1
+
+        cached = SEARCH_CACHE.get_page(search_term, img_size, next_start_index)
+        if cached:
+            links, following_start_index = cached
+            term_logger.info('Cached page for term:{} size:{} start_index:{}'.format(search_term, img_size, next_start_index))
+        else:
+            if not PLANNER.spend(search_term):
+                term_logger.info("No search API calls left for {} this round".format(search_term))
+                return
+            if not RATE_LIMITER.api_request():
+                term_logger.info("Daily search API quota used up, not searching {}".format(search_term))
+                return
+            query_url = assemble_query(search_term, img_size, next_start_index)
+            try:
+                term_logger.info('Requesting url with term:{} size:{} start_index:{}'.format(search_term, img_size, next_start_index))
+                r = TRANSPORT.get(query_url, vars['search_timeout'])
+                if r.status_code != requests.codes.ok:
+                    r.raise_for_status()
+                json_data = r.json()
+
+                if not json_data:
+                    #json data is empty if there are no more search results so try with another image size
+                    term_logger.info("No search results for {} {}".format(search_term, img_size))
+                    PLANNER.record(search_term, img_size, 0, 0)
+                    yield from search_for_images(search_term, img_sizes[1:], num_urls_desired - urls_found, urls, wrapped)
+                    return
+
+                links = [item['link'] for item in json_data['items']]
+                try:
+                    following_start_index = json_data['queries']['nextPage'][0]['startIndex']
+                except KeyError:
+                    following_start_index = None
+                SEARCH_CACHE.put_page(search_term, img_size, next_start_index, links, following_start_index)
+
+            except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+                error_str = 'Query Error: {}'.format(query_url)
+                main_logger.info(error_str)
+                term_logger.info(error_str)
+                main_logger.info(e)
+                term_logger.info(e)
+                return
+
+        next_start_index = following_start_index
+        if next_start_index is not None:
+            SEARCH_CACHE.set_cursor(search_term, img_size, next_start_index)
+
+        fresh = [link for link in links if wanted(link)]
+        if not cached:
+            PLANNER.record(search_term, img_size, len(links), len(fresh))
+
+        for link in fresh:
+            urls.add(link)
+            urls_found += 1
+            term_logger.info("Found {} {}".format(link, img_size))
+            yield link
+            if urls_found == num_urls_desired:
+                break
+
+        if not cached and not fresh and len(img_sizes) > 1:
+            #a page with nothing new suggests this size is played out for now, give the next one a go
+            yield from search_for_images(search_term, img_sizes[1:], num_urls_desired - urls_found, urls, wrapped)
+            return
 
-        try:
-            term_logger.info('Requesting url with term:{} size:{} start_index:{}'.format(search_term, img_size, next_start_index))
-            r = requests.get(query_url)
-            if r.status_code != requests.codes.ok:
-                r.raise_for_status()
-            json_data = r.json()
-
-            if not json_data:
-                #json data is empty if there are no more search results so try with another image size
-                term_logger.info("No search results for {} {}".format(search_term, img_size))
-                return urls.union(search_for_images(search_term, img_sizes[1:], num_urls_desired - len(urls)))
-
-            for item in json_data['items']:
-                link = item['link']
-
-                #filter out x-raw-image:// urls
-                if re.match('^https?://', link) and link not in urls and link not in IMAGE_BLACKLIST:
-                    filename_hash = hashlib.sha1(link.encode('utf-8')).hexdigest()
-                    filepath = os.path.join(IMAGE_DIR, search_term, filename_hash)
-                    if filepath not in IMAGES:
-                        urls.add(link)
-                        urls_found += 1
-                        term_logger.info("Found {} {} {}".format(filepath, img_size, filename_hash))
-                        if urls_found == num_urls_desired:
-                            break
-
-            next_start_index = json_data['queries']['nextPage'][0]['startIndex']
-            QUERY_CACHE[search_term+img_size] = next_start_index
-
-        except (requests.exceptions.RequestException, KeyError) as e:
-            error_str = 'Query Error: {}'.format(query_url)
-            main_logger.info(error_str)
-            term_logger.info(error_str)
-            main_logger.info(e)
-            term_logger.info(e)
-            return urls
-
-    return urls
-
-def display_loading_progress(search_term, term_url_count, total_urls, urls_processed, term_count):
+def display_loading_progress(search_term, term_url_count, total_urls, urls_processed, term_count, searching=False):
+    #while searches are still running the totals can grow, which a trailing + shows
+    more = '+' if searching else ''
 
     percent_complete = (urls_processed/float(total_urls)) * 100
     percent_complete = int(percent_complete)
     msg = "{}%".format(percent_complete)
+    lines = {'percent': (msg, (random.randint(0,255), random.randint(0,255), random.randint(0,255)))}
 
-    loading_font_size = LOADING_FONT.get_ascent()
-    text = LOADING_FONT.render(msg, 1, (random.randint(0,255), random.randint(0,255), random.randint(0,255)))
-    x_coord = SCREEN_WIDTH - len(msg) * loading_font_size
-    y_coord = 0
-
-    SCREEN_LOCK.acquire()
-    screen.fill(RGB_BLACK, Rect(x_coord, y_coord, len(msg) * loading_font_size, loading_font_size + TEXT_PADDING))
-    screen.blit(text, (x_coord, y_coord))
-
-    if not DETAILED_PROGRESS:
-        display.flip()
-        SCREEN_LOCK.release()
-        return
-
-    progress_font_size = LOADING_FONT_DETAILED.get_ascent()
-    y_coord = SCREEN_HEIGHT - progress_font_size - TEXT_PADDING
-    screen.fill(RGB_BLACK, Rect(0, y_coord, SCREEN_WIDTH, progress_font_size + TEXT_PADDING))
+    if DETAILED_PROGRESS:
+        msg = 'Total: {}/{}{} urls Search Term:"{}":{}/{}{} urls'.format(urls_processed, total_urls, more, search_term, term_count, term_url_count, more)
+        lines['total'] = (msg, FONT_COLOR)
 
-    msg = 'Total: {}/{} urls Search Term:"{}":{}/{} urls'.format(urls_processed, total_urls, search_term, term_count, term_url_count)
-    text = LOADING_FONT_DETAILED.render(msg, 1, FONT_COLOR)
-    screen.blit(text, (0, y_coord))
-    display.flip()
-    SCREEN_LOCK.release()
+    RENDERER.update_progress(**lines)
 
 def display_file_download_progress(content_length, bytes_read, url, percent_complete):
     if not DETAILED_PROGRESS:
         return
 
-    SCREEN_LOCK.acquire()
-    progress_font_size = LOADING_FONT_DETAILED.get_ascent()
-    y_coord_url = SCREEN_HEIGHT - progress_font_size*3 - TEXT_PADDING*3
-    y_coord_dl = SCREEN_HEIGHT - progress_font_size*2 - TEXT_PADDING*2
-    screen.fill(RGB_BLACK, Rect(0, y_coord_url, SCREEN_WIDTH, progress_font_size + TEXT_PADDING))
-    screen.fill(RGB_BLACK, Rect(0, y_coord_dl, SCREEN_WIDTH, progress_font_size + TEXT_PADDING))
-
-    text = LOADING_FONT_DETAILED.render(url, 1, FONT_COLOR)
-    screen.blit(text, (0, y_coord_url))
-
     msg = "Download progress {}B/{}B".format(bytes_read, content_length)
     msg = msg + " {0:.2f}%".format(percent_complete)
-    text = LOADING_FONT_DETAILED.render(msg, 1, FONT_COLOR)
-    screen.blit(text, (0, y_coord_dl))
-
-    display.flip()
-    SCREEN_LOCK.release()
+    RENDERER.update_progress(url=(url, FONT_COLOR), download=(msg, FONT_COLOR))
 
 def clear_progress():
-    font_size = LOADING_FONT_DETAILED.get_ascent()
-    y_coord = SCREEN_HEIGHT - font_size*3 - TEXT_PADDING*3
-    height = SCREEN_HEIGHT - y_coord
-    screen.fill(RGB_BLACK, Rect(0, y_coord, SCREEN_WIDTH, height))
-    display.flip()
+    RENDERER.clear_progress()
 
-def download_file(response, img, url):
+class DownloadRejected(Exception):
+    '''The response is not something we want to keep: not an image, or too large'''
+    pass
 
-    content_length = int(response.info().get('Content-Length').strip())
+def download_file(response, img, url):
+    '''Stream the body into img, giving up as soon as it is clearly not an image or
+    grows past max_download_mb. Content-Length is only a hint, chunked responses have none.'''
+    max_bytes = vars['max_download_mb'] * 1024 * 1024
+    try:
+        content_length = int(response.headers['Content-Length'].strip())
+    except (KeyError, ValueError):
+        content_length = None
+    if content_length and content_length > max_bytes:
+        raise DownloadRejected("{}B is over the {}B limit".format(content_length, max_bytes))
+
+    head = b''
+    digest = hashlib.sha1()
     bytes_read = 0
     percent_complete = 0
 
-    while True:
-        chunk = response.read(CHUNK_SIZE)
-
-        if not chunk:
-            return
+    for chunk in response.iter_content(CHUNK_SIZE):
+        if len(head) < imageconvert.SNIFF_BYTES:
+            head += chunk[:imageconvert.SNIFF_BYTES - len(head)]
+            if len(head) >= imageconvert.SNIFF_BYTES and not imageconvert.sniff_format(head):
+                raise DownloadRejected("Not an image ({})".format(response.headers.get('Content-Type')))
 
         bytes_read += len(chunk)
-        last_percent_complete = percent_complete
-        percent_complete = (bytes_read/float(content_length)) * 100
+        if bytes_read > max_bytes:
+            raise DownloadRejected("Over the {}B limit".format(max_bytes))
         img.write(chunk)
+        digest.update(chunk)
+        RATE_LIMITER.download(len(chunk))
+
+        if content_length:
+            last_percent_complete = percent_complete
+            percent_complete = (bytes_read/float(content_length)) * 100
+            if percent_complete - last_percent_complete > 1:
+                display_file_download_progress(content_length, bytes_read, url, percent_complete)
+
+    #bodies shorter than SNIFF_BYTES never got checked above
+    if not imageconvert.sniff_format(head):
+        raise DownloadRejected("Not an image ({})".format(response.headers.get('Content-Type')))
+    return digest.hexdigest()
+
+def download_url(url, search_term):
+    '''Download one image into its search term dir. Runs on a DownloadPool thread.
+    The body goes to a .part file that is renamed into place only once it is complete
+    and looks like an image, so a partial or bogus file never reaches IMAGES.
+    A picture we already have, under any url or term, is hardlinked instead of stored again.
+    Returns True if the image was added to IMAGES'''
+    term_logger = logger_store[search_term]
+    filename_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    filename = os.path.join(IMAGE_DIR, search_term, filename_hash)
+
+    #a url another term already downloaded needs no download at all
+    existing = CONTENT_INDEX.find_url(url)
+    if existing:
+        if os.path.dirname(existing) == os.path.dirname(filename):
+            #this term already has it, e.g. a cached search page handed out the url again
+            term_logger.info("Already have {} {}".format(url, existing))
+            return False
+        if link_duplicate(existing, filename, url, search_term):
+            return True
+
+    fd, tmp_path = tempfile.mkstemp(dir=PARTIAL_DIR, suffix=PARTIAL_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as img:
+            try:
+                with TRANSPORT.get(url, vars['download_timeout'], stream=True) as response:
+                    response.raise_for_status()
+                    digest = download_file(response, img, url)
+            except (requests.exceptions.RequestException, DownloadRejected) as e:
+                main_logger.info(e)
+                term_logger.info("{} {}".format(url, e))
 
-        if percent_complete - last_percent_complete > 1:
-            display_file_download_progress(content_length, bytes_read, url, percent_complete)
+                status = getattr(e.response, 'status_code', None) if isinstance(e, requests.exceptions.HTTPError) else None
+                permanent = isinstance(e, DownloadRejected) or status in PERMANENT_HTTP_ERRORS
+                until = IMAGE_BLACKLIST.record_failure(url, permanent)
+                term_logger.info('Blacklisted url:{} {}'.format(url, 'for good' if permanent else 'until {}'.format(time.ctime(until))))
+                term_logger.info("Failed to download {}".format(url))
+                return False
+
+        existing = CONTENT_INDEX.find(digest)
+        if existing:
+            if os.path.dirname(existing) == os.path.dirname(filename):
+                #this term already has the picture under another url
+                CONTENT_INDEX.add_url(url, digest)
+                term_logger.info("Duplicate of {} {}".format(existing, url))
+                return False
+            return link_duplicate(existing, filename, url, search_term)
+
+        os.replace(tmp_path, filename)
+    finally:
+        #whatever went wrong, and for duplicates, the .part file is not needed any more
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    if vars['ingest_normalize']:
+        ingest_image(filename, search_term)
+    try:
+        with Image.open(filename) as pil_image:
+            dimensions = pil_image.size
+        phash = imageconvert.dhash(filename)
+    except (IOError, ValueError, Image.DecompressionBombError) as e:
+        term_logger.info("No perceptual hash for {}: {}".format(filename, e))
+        dimensions, phash = (None, None), None
+    CONTENT_INDEX.add(filename, url, digest, phash)
+    CATALOG.add(filename, search_term, dimensions)
+
+    add_image(filename)
+    term_logger.info("Downloaded {} {}".format(url, filename_hash))
+    return True
+
+def link_duplicate(existing, filename, url, search_term):
+    '''Show the picture stored at existing under search_term as well, without another copy.
+    Returns True if the link was made.'''
+    term_logger = logger_store[search_term]
+    try:
+        CONTENT_INDEX.link(existing, filename, url)
+    except (OSError, KeyError) as e:
+        term_logger.info("Could not link {} to {}: {}".format(filename, existing, e))
+        return False
+    CATALOG.add(filename, search_term, CATALOG.dimensions(existing))
 
-def download_images(term_dict, total_urls):
+    add_image(filename)
+    term_logger.info("Linked {} to {} {}".format(url, existing, filename))
+    return True
 
-    urls_processed = 0
-    successful_downloads = 0
-    for search_term in term_dict:
-        term_logger = logger_store[search_term]
-        search_images_dir = os.path.join(IMAGE_DIR, search_term)
-        url_count = len(term_dict[search_term])
-
-        for i,url in enumerate(term_dict[search_term]):
-            filename_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()
-            filename = os.path.join(search_images_dir, filename_hash)
-            error = False
-
-            with open(filename, 'wb') as img:
-                try:
-                    response = urllib.request.urlopen(urllib.request.Request(url, headers={'User-Agent': USER_AGENT}))
-                    download_file(response, img, url)
-                    IMAGES_LOCK.acquire()
-                    IMAGES.add(filename)
-                    IMAGES_LOCK.release()
-                    term_logger.info("Downloaded {} {}".format(url, filename_hash))
-                    successful_downloads = successful_downloads + 1
-                except (urllib.error.HTTPError, urllib.error.URLError, AttributeError) as e:
-                    error = True
-                    main_logger.info(e)
-                    term_logger.info(e)
-
-                    IMAGE_BLACKLIST.add(url)
-                    term_logger.info('Blacklisted url:{}'.format(url))
-
-            if error and os.path.exists(filename):
-                os.unlink(filename)
-                term_logger.info("Failed to download {}".format(url))
+def add_image(filename):
+    IMAGES_LOCK.acquire()
+    IMAGES.add(filename)
+    IMAGES_LOCK.release()
+    notify_images_changed()
+
+def ingest_image(filename, search_term):
+    '''Replace a freshly downloaded image with a compact screen sized rendition,
+    so it never has to be fitted again. Small images and animations stay as they are.'''
+    term_logger = logger_store[search_term]
+    original_size = os.stat(filename).st_size
+
+    try:
+        with Image.open(filename) as pil_image:
+            if getattr(pil_image, 'is_animated', False):
+                return
+            if pil_image.size[0] <= SCREEN_WIDTH and pil_image.size[1] <= SCREEN_HEIGHT:
+                return
+        pil_image = imageconvert.fit_image(filename, IMAGE_SIZE, vars['resample_filter'])
+    except (IOError, ValueError, Image.DecompressionBombError) as e:
+        term_logger.info("Not normalizing {}: {}".format(filename, e))
+        return
+
+    fd, tmp_path = tempfile.mkstemp(dir=PARTIAL_DIR, suffix=PARTIAL_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as rendition:
+            imageconvert.save_rendition(pil_image, rendition, vars['ingest_quality'])
+        stored_size = os.stat(tmp_path).st_size
+
+        if stored_size >= original_size:
+            return
 
-            display_loading_progress(search_term, url_count, total_urls, urls_processed, i+1)
-            urls_processed += 1
-    return successful_downloads
+        if vars['keep_originals']:
+            originals_dir = os.path.join(ORIGINALS_DIR, search_term)
+            os.makedirs(originals_dir, exist_ok=True)
+            os.replace(filename, os.path.join(originals_dir, os.path.basename(filename)))
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    term_logger.info("Normalized {} {}B -> {}B".format(filename, original_size, stored_size))
+
+    with INGEST_LOCK:
+        INGEST_STATS['images'] += 1
+        INGEST_STATS['original_bytes'] += original_size
+        INGEST_STATS['stored_bytes'] += stored_size
+        with open(INGEST_STATS_FILENAME, 'w') as ingest_stats_file:
+            json.dump(INGEST_STATS, ingest_stats_file)
+
+def ingest_savings():
+    with INGEST_LOCK:
+        return dict(INGEST_STATS, saved_bytes=INGEST_STATS['original_bytes'] - INGEST_STATS['stored_bytes'])
 
 def setup_term_logger(term):
     search_images_dir = os.path.join(IMAGE_DIR, term)
@@ -401,112 +620,159 @@ def setup_term_logger(term):
     return logger
 
 def search_term_download():
-    term_dict = {}
-    total_urls = 0
+    '''Search and download at the same time. Search workers hand each new url to the
+    download pool as soon as its page of results arrives. The pool holds at most
+    pipeline_queue_size urls, so searching waits whenever downloading falls behind.'''
+    terms = list(vars['search_terms'])
+    #API calls go to the terms that have been turning up new images
+    calls = vars['api_calls_per_refresh'] or 3 * len(terms)
+    main_logger.info('Search API calls per term: {}'.format(PLANNER.allocate(terms, IMAGE_SIZES, calls)))
+    pool = DownloadPool(download_url, vars['download_workers'], vars['downloads_per_host'], vars['pipeline_queue_size'])
+
+    progress_lock = threading.Lock()
+    term_url_count = {term: 0 for term in terms}
+    searching = set(terms)
+
+    def search(term):
+        try:
+            for url in search_for_images(term, PLANNER.order_sizes(term, IMAGE_SIZES)):
+                with progress_lock:
+                    term_url_count[term] += 1
+                pool.add(url, term)
+        finally:
+            with progress_lock:
+                searching.discard(term)
+
+    searchers = ThreadPoolExecutor(vars['search_workers'])
+    searches = [searchers.submit(search, term) for term in terms]
 
-    for term in vars['search_terms']:
-        term_dict[term] = search_for_images(term, IMAGE_SIZES)
-        total_urls += len(term_dict[term])
+    def close_when_searched():
+        for term, future in zip(terms, searches):
+            if future.exception():
+                main_logger.info('Search for {} failed: {}'.format(term, future.exception()))
+        pool.close()
 
-    items_downloaded = download_images(term_dict, total_urls)
+    threading.Thread(target=close_when_searched, daemon=True).start()
+
+    urls_processed = 0
+    items_downloaded = 0
+    term_processed = {term: 0 for term in terms}
+    for (url, search_term), downloaded, error in pool.results():
+        if error:
+            main_logger.info('Download of {} failed: {}'.format(url, error))
+        elif downloaded:
+            items_downloaded = items_downloaded + 1
+
+        urls_processed += 1
+        term_processed[search_term] += 1
+        with progress_lock:
+            total_urls = sum(term_url_count.values())
+            url_count = term_url_count[search_term]
+            still_searching = bool(searching)
+        display_loading_progress(search_term, url_count, total_urls, urls_processed, term_processed[search_term], still_searching)
+
+    pool.shutdown()
+    searchers.shutdown()
     server.new_term_event.clear()
+    clear_progress()
 
     if items_downloaded:
         REFRESH_EVENT.set()
-
-def check_for_exit():
-    for e in pygame.event.get():
-        if e.type == pygame.KEYDOWN:
-            if e.key == pygame.K_q:
-                end()
-            elif e.key == pygame.K_d:
-                server.new_term_event.set()
+        if vars['image_budget_mb'] > 0 or vars['term_quota_mb'] > 0 or vars['min_free_mb'] > 0:
+            #make room now rather than at the next daily clean
+            server.clean_event.set()
 
 def display_loading():
     '''Loading screen that displays if less than 10 images are available'''
 
     gifs = os.listdir(LOAD_IMAGE_DIR)
-    loading_gif = GIFImage(os.path.join(LOAD_IMAGE_DIR, random.choice(gifs)))
+    loading_gif = GIFImage(os.path.join(LOAD_IMAGE_DIR, random.choice(gifs)), stream=True)
 
     x_coord = get_center_width_offset(loading_gif.image)
     y_coord = get_center_height_offset(loading_gif.image)
 
-    screen.fill(RGB_BLACK)
+    #the renderer animates the gif, we only wait for enough images
+    RENDERER.show_loading(loading_gif, (x_coord,y_coord))
 
     while True:
-
-        SCREEN_LOCK.acquire()
-        loading_gif.render(screen, (x_coord,y_coord))
-        display.flip()
-        SCREEN_LOCK.release()
-
-        check_for_exit()
-
         IMAGES_LOCK.acquire()
         if len(IMAGES) >= LOADING_PAGE_THRESHOLD:
             IMAGES_LOCK.release()
             return
         IMAGES_LOCK.release()
 
+        #sleeps until a key press or the downloader adds an image
+        handle_event(wait_event())
 
-def scan_input():
+
+def wait_event():
+    '''Sleep until the next pygame event, drawing whatever the renderer has queued or
+    has due meanwhile. SDL wants all drawing on this, the main, thread.'''
+    while True:
+        RENDERER.pump()
+        timeout = RENDERER.timeout()
+        if timeout is None:
+            e = pygame.event.wait()
+        else:
+            #a timeout of 0 would wait forever
+            e = pygame.event.wait(max(1, int(timeout * 1000)))
+        if e.type not in (pygame.NOEVENT, RENDER_EVENT):
+            return e
+
+def handle_event(e):
     '''
     q - quits
     d - initiate download event
     arrow keys - advance the image
     i - display image position i.e 3/10
     delete - stop displaying the image and delete it. advance to the next image
-    :return:
+    :return: the key that moves the slide show, or FLIP_EVENT when it is time to flip
     '''
     global SHOW_IMAGE_POSITION
 
-    e = pygame.event.poll()
-    while e.type != pygame.NOEVENT:
-        if e.type == pygame.QUIT:
-            end()
+    if e.type == pygame.QUIT:
+        end()
 
-        if e.type == pygame.KEYDOWN:
-            if e.key == pygame.K_q:
-                end()
-            elif e.key == pygame.K_d:
-                server.new_term_event.set()
-            elif e.key == pygame.K_LEFT:
-                return pygame.K_LEFT
-            elif e.key == pygame.K_RIGHT:
-                return pygame.K_RIGHT
-            elif e.key == pygame.K_i:
-                SHOW_IMAGE_POSITION = not SHOW_IMAGE_POSITION
-            elif e.key == pygame.K_DELETE:
-                return pygame.K_DELETE
-        e = pygame.event.poll()
+    if e.type == FLIP_EVENT:
+        return FLIP_EVENT
 
-def idle_and_scan_input():
-    start = datetime.datetime.now()
-    next_tick = datetime.datetime.now()
-    input_scan_rate = .1 # sec
+    if e.type == pygame.KEYDOWN:
+        if e.key == pygame.K_q:
+            end()
+        elif e.key == pygame.K_d:
+            server.new_term_event.set()
+        elif e.key == pygame.K_LEFT:
+            return pygame.K_LEFT
+        elif e.key == pygame.K_RIGHT:
+            return pygame.K_RIGHT
+        elif e.key == pygame.K_i:
+            SHOW_IMAGE_POSITION = not SHOW_IMAGE_POSITION
+            RENDERER.show_position_indicator(SHOW_IMAGE_POSITION)
+        elif e.key == pygame.K_DELETE:
+            return pygame.K_DELETE
 
-    while (next_tick - start).seconds < vars['flip_frequency']:
-        input = scan_input()
-        if input:
-            return input
-        time.sleep(input_scan_rate)
-        next_tick = datetime.datetime.now()
+def idle_and_scan_input():
+    '''Block until a key moves the slide show or the flip timer fires. Returns None on the timer.'''
+    pygame.time.set_timer(FLIP_EVENT, max(1, int(vars['flip_frequency'] * 1000)), 1)
+    try:
+        while True:
+            input = handle_event(wait_event())
+            if input == FLIP_EVENT:
+                return None
+            if input:
+                return input
+    finally:
+        pygame.time.set_timer(FLIP_EVENT, 0)
 
 #*args for linux compatibility
 def end(*args):
     main_logger.info('Exiting....')
 
-    for conv_file in CONVERT_CACHE.values():
-        os.unlink(conv_file)
-
-    with open(IMAGE_BLACKLIST_FILENAME, 'w') as blacklist:
-        blacklist.writelines('\n'.join(IMAGE_BLACKLIST))
+    IMAGE_BLACKLIST.close()
+    CONTENT_INDEX.close()
+    CATALOG.close()
 
-    try:
-        with open("qc.pickle",'wb') as qc_pickle_file:
-            pickle.dump(QUERY_CACHE, qc_pickle_file, pickle.DEFAULT_PROTOCOL)
-    except (pickle.PickleError, pickle.PicklingError) as e:
-        main_logger.info('Failed to pickle query cache: {}'.format(e))
+    SEARCH_CACHE.close()
 
     config.save_config()
     server.shutdown()
@@ -514,6 +780,18 @@ def end(*args):
     pygame.quit()
     sys.exit(0)
 
+def next_index(images, i):
+    '''Index of the next image to show after images[i], passing over pictures
+    that are (nearly) the same as images[i] so they are not shown back to back'''
+    following = (i + 1) % len(images)
+    if not vars['skip_near_duplicates']:
+        return following
+    for step in range(1, len(images)):
+        following = (i + step) % len(images)
+        if not CONTENT_INDEX.similar(images[i], images[following], vars['near_duplicate_bits']):
+            return following
+    return (i + 1) % len(images)
+
 def run():
 
     if not os.path.exists(IMAGE_DIR):
@@ -521,37 +799,56 @@ def run():
 
     threading.Thread(target=server.serve_forever, daemon=True).start()
     ImageDownloader(IMAGES, search_term_download, server).start()
+    prefetcher = ImagePrefetcher(load_slide, vars['prefetch_depth'])
+    prefetcher.start()
 
-    IMAGES_LOCK.acquire()
-    images = list(IMAGES)
-    IMAGES_LOCK.release()
-
+    #the playlist keeps its order as images come and go, so the slide show
+    #follows the image on screen by path rather than by index
     i = 0
+    #slides moved forward through since the last deal, so only a whole pass deals again
+    advanced = 0
 
     while True:
-        if len(images) < LOADING_PAGE_THRESHOLD:
+        if len(IMAGES) < LOADING_PAGE_THRESHOLD:
             display_loading()
 
-            #refresh images with those newly downloaded
-            IMAGES_LOCK.acquire()
-            images = list(IMAGES)
-            IMAGES_LOCK.release()
-
-        image = images[i]
+        image = IMAGES[i]
+        position = IMAGES.position(image)
+        if position is None:
+            #removed by another thread just now, whatever took its place is next
+            continue
+        i = position
+        prefetcher.update(IMAGES, i)
         try:
-            display_image(image, i)
+            slide = prefetcher.get(image)
+            if slide is None:
+                slide = load_slide(image)
+            display_image(slide, i)
+            CATALOG.shown(image)
         except IOError:
-            i = (i + 1) % len(images)
+            i = i + 1
             continue
 
         input = idle_and_scan_input()
+
+        # images may have come or gone while this one was up: 1) ImageCleaner cleaned out images
+        # or 2) The server added/removed extra images to display ("extra_images")
+        # or 3) ImageDownloader finished downloading new images
+        REFRESH_EVENT.clear()
+        position = IMAGES.position(image)
+        if position is not None:
+            i = position
+
         if input == pygame.K_LEFT:
-            i = (i - 1) % len(images)
+            i = i - 1
+            advanced = max(0, advanced - 1)
         elif input == pygame.K_DELETE:
             IMAGES_LOCK.acquire()
-            IMAGES.remove(image)
-            images = list(IMAGES)
-            i = (i - 1) % len(images)
+            IMAGES.discard(image)
+            CONTENT_INDEX.remove(image)
+            CATALOG.remove([image])
+            prefetcher.discard(image)
+            i = i - 1
             IMAGES_LOCK.release()
 
             try:
@@ -559,17 +856,15 @@ def run():
             except OSError as e:
                 main_logger.info(e)
         elif input == pygame.K_RIGHT or input is None:
-            i = (i + 1) % len(images)
-
-        # reload the images to display because 1) ImageCleaner cleaned out images
-        # or 2) The server added/removed extra images to display ("extra_images")
-        # or 3) ImageDownloader finished downloading new images
-        if REFRESH_EVENT.is_set():
-            IMAGES_LOCK.acquire()
-            images = list(IMAGES)
-            i = 0
-            IMAGES_LOCK.release()
-            REFRESH_EVENT.clear()
+            following = next_index(IMAGES, i)
+            advanced += 1
+            if following <= i and advanced >= len(IMAGES):
+                #round the whole playlist, deal a fresh order for the next time round.
+                #Wrapping after stepping back past the first slide keeps the order.
+                IMAGES.shuffle()
+                following = 0
+                advanced = 0
+            i = following
 
 
 
@@ -577,6 +872,13 @@ def run():
 
 screen = display.set_mode(IMAGE_SIZE, pygame.FULLSCREEN)
 # screen = display.set_mode(IMAGE_SIZE)
+#only wake the main loop for events it acts on
+pygame.event.set_blocked(None)
+pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, FLIP_EVENT, IMAGES_CHANGED_EVENT, RENDER_EVENT])
+RENDERER = Renderer(screen, OVERLAY, RGB_BLACK, LOADING_FONT_DETAILED, FONT_COLOR,
+                    lambda: pygame.event.post(pygame.event.Event(RENDER_EVENT)))
+server.register_stats('renderer', RENDERER.stats)
+server.register_stats('ingest', ingest_savings)
 signal.signal(signal.SIGINT,end)
 run()
 
@@ -0,0 +1,111 @@
+'''Fitting images to the screen and handing them to pygame.
+Kept apart from display.py so the conversion can run (and be benchmarked)
+without opening a window.'''
+
+import pygame
+from PIL import Image
+
+#pixel layouts pygame can take straight from a PIL buffer
+SURFACE_MODES = ('RGB', 'RGBA')
+
+#speed/quality trade off when resampling to screen size, fastest first
+RESAMPLE_FILTERS = {'nearest': Image.NEAREST,
+                    'box': Image.BOX,
+                    'bilinear': Image.BILINEAR,
+                    'hamming': Image.HAMMING,
+                    'bicubic': Image.BICUBIC,
+                    'lanczos': Image.LANCZOS}
+DEFAULT_RESAMPLE = 'bicubic'
+
+#how far above the target size an image may be decoded before the final resample.
+#Larger is sharper, smaller is faster.
+REDUCING_GAP = 2.0
+
+def fit_size(size, image_size):
+    '''Largest size with the aspect ratio of size that fits in image_size'''
+    width, height = size
+    screen_width, screen_height = image_size
+    ratio = min(float(screen_width) / width, float(screen_height) / height)
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+def fit_image(image_path, image_size, resample=DEFAULT_RESAMPLE):
+    '''Decode an image no larger than it needs to be and resample it to fit the screen'''
+    pil_image = Image.open(image_path)
+    target = fit_size(pil_image.size, image_size)
+
+    if pil_image.format == 'JPEG':
+        #DCT scaling: the decoder skips straight to 1/2, 1/4 or 1/8 scale, staying above target
+        pil_image.draft(pil_image.mode, (int(target[0] * REDUCING_GAP), int(target[1] * REDUCING_GAP)))
+
+    if pil_image.mode in ('1', 'P'):
+        #palette images can only be resampled with nearest neighbour
+        pil_image = pil_image.convert('RGBA' if has_alpha(pil_image) else 'RGB')
+
+    if pil_image.size == target:
+        pil_image.load()
+        return pil_image
+
+    #reducing_gap lets pil reduce() by an integer factor before the final resample,
+    #which does the same job as draft() for formats without DCT scaling
+    return pil_image.resize(target, RESAMPLE_FILTERS.get(resample, RESAMPLE_FILTERS[DEFAULT_RESAMPLE]),
+                            reducing_gap=REDUCING_GAP)
+
+def pil_to_surface(pil_image):
+    '''Hand the pixels of a PIL image to pygame without an encode/decode pass'''
+    if pil_image.mode not in SURFACE_MODES:
+        pil_image = pil_image.convert('RGBA' if has_alpha(pil_image) else 'RGB')
+
+    #frombuffer wraps the bytes instead of copying them a second time into the surface
+    return pygame.image.frombuffer(pil_image.tobytes(), pil_image.size, pil_image.mode)
+
+def to_display_format(surface):
+    '''Copy a surface into the display's pixel format once, so blitting it is a plain copy.
+    Needs the display mode to be set, and like every SDL video call, the main thread.'''
+    if surface.get_flags() & pygame.SRCALPHA:
+        return surface.convert_alpha()
+    return surface.convert()
+
+def has_alpha(pil_image):
+    return pil_image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in pil_image.info
+
+def save_rendition(pil_image, fp, jpeg_quality=90):
+    '''Save a fitted image compactly: JPEG unless it needs its alpha channel'''
+    if has_alpha(pil_image):
+        if pil_image.mode != 'RGBA':
+            pil_image = pil_image.convert('RGBA')
+        pil_image.save(fp, format='PNG')
+    else:
+        if pil_image.mode != 'RGB':
+            pil_image = pil_image.convert('RGB')
+        pil_image.save(fp, format='JPEG', quality=jpeg_quality)
+
+#leading bytes of every format we can show, checked before a download is kept
+MAGIC_NUMBERS = ((b'\xff\xd8\xff', 'JPEG'),
+                 (b'\x89PNG\r\n\x1a\n', 'PNG'),
+                 (b'GIF87a', 'GIF'),
+                 (b'GIF89a', 'GIF'),
+                 (b'BM', 'BMP'))
+SNIFF_BYTES = 12
+
+def sniff_format(head):
+    '''Image format named by the first SNIFF_BYTES of a file, or None if it is not an image'''
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    for magic, name in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return name
+    return None
+
+def dhash(image_path):
+    '''64 bit difference hash: whether each pixel of a 9x8 greyscale thumbnail is
+    brighter than its right hand neighbour. Resizing, recompression and small edits
+    flip few bits, different pictures flip about half of them.'''
+    with Image.open(image_path) as pil_image:
+        pil_image.draft('L', (64, 64))
+        pixels = list(pil_image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits